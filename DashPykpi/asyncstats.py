@@ -0,0 +1,175 @@
+"""Asynchronous harvesting of Github repo statistics (Python 3.5+ only)
+
+Needs the optional `aiohttp <http://aiohttp.readthedocs.io>`_ package.
+"""
+import asyncio
+import time
+import aiohttp
+from DashPykpi.kpistats import KpiStats, split_github_url
+
+API_URL = 'https://api.github.com'
+
+
+class AsyncKpiStats(KpiStats):
+    """**Gathers repo statistics from Github with asyncio into a TinyDB**
+
+    A drop in alternative to KpiStats() that doesn't tie up a thread per
+    repo. The contributor statistics, branch and commit activity requests of
+    a repo are sent at once, and up to `concurrency` requests are in flight
+    over a pool of client.pool_size kept-alive connections (see
+    GitHubClient()), so a repo takes about
+    as long as its slowest request. Stats requests that Github answers with
+    202 (stats still being computed for a cold repo) are retried after a
+    pause. A repo whose requests fail (e.g. a 404 for a deleted repo, a
+    timeout, or no repo details at all) is skipped, and the error is kept in
+    self.failed[url].
+
+    The stats dictionaries are the same as KpiStats.get_repo_stats() makes,
+    and are written to the DB one by one with KpiStats.add_db_row(). The
+    credentials of the GitHubClient() (made by default) are used to
+    authenticate, and the sharding options are as for KpiStats().
+
+    :param urls: list of url strings ['https://github.com/<user>/<repo>',]
+    :param db_file: path of the TinyDB file to write to
+    :param client: GitHubClient() whose credentials are used
+    :param concurrency: max number of requests in flight at once
+    :param retries: number of times a 202 response is retried
+    :param retry_wait: seconds to wait before the first retry (doubled for
+                       each retry after it)
+
+    :Example:
+
+    >>> from DashPykpi.asyncstats import AsyncKpiStats
+    >>> test = AsyncKpiStats(urls=["https://github.com/UCL-RITS/DashPykpi"])
+    >>> test.work(status=True)
+    """
+    def __init__(self, urls, db_file='tinydb_for_KPI.json', client=None,
+                 shard_index=None, shard_count=None, concurrency=200,
+                 retries=5, retry_wait=1.):
+        super(AsyncKpiStats, self).__init__(
+            urls, db_file=db_file, client=client, shard_index=shard_index,
+            shard_count=shard_count)
+        self.concurrency = concurrency
+        self.retries = retries
+        self.retry_wait = retry_wait
+        self.api_url = API_URL
+        self.semaphore = None
+        self.failed = {}  # url: error, for repos that couldn't be harvested
+
+    def __str__(self):
+        return "An asyncio KPI back-end to extract data from Github."
+
+    def session(self):
+        """An aiohttp.ClientSession authenticated as self.client"""
+        headers = {'Accept': 'application/vnd.github.v3+json'}
+        auth = None
+        if self.client.token:
+            headers['Authorization'] = 'token {0}'.format(self.client.token)
+        else:
+            auth = aiohttp.BasicAuth(self.client.username,
+                                     self.client.password)
+        connect, read = self.client.timeout
+        timeout = aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+        connector = aiohttp.TCPConnector(limit=self.client.pool_size)
+        return aiohttp.ClientSession(connector=connector, headers=headers,
+                                     auth=auth, timeout=timeout)
+
+    async def get_json(self, session, url, params=None):
+        """GET a Github API url, retrying while Github answers 202
+
+        :returns: (decoded JSON, dictionary of the response's Link urls)
+        """
+        wait = self.retry_wait
+        for attempt in range(self.retries + 1):
+            async with self.semaphore:
+                async with session.get(url, params=params) as resp:
+                    resp.raise_for_status()
+                    if resp.status == 204:
+                        return [], {}  # No stats for an empty repo
+                    if resp.status != 202:
+                        links = dict((rel, link['url'])
+                                     for rel, link in resp.links.items())
+                        return await resp.json(), links
+            if attempt < self.retries:
+                await asyncio.sleep(wait)
+                wait *= 2
+        return [], {}  # Stats are still being computed, none to give yet
+
+    async def get_all(self, session, url):
+        """GET every page of a paginated Github API url as one list"""
+        items, links = await self.get_json(session, url,
+                                           params={'per_page': 100})
+        while 'next' in links:
+            page, links = await self.get_json(session, str(links['next']))
+            items.extend(page)
+        return items
+
+    async def repo_stats(self, session, url):
+        """Identify the statistics of an individual repo url
+
+        :param url: a string of format 'https://github.com/<user>/<repo>'
+        :rtype: A dictionary of the same form as KpiStats.get_repo_stats()
+        """
+        user_str, repo_str = split_github_url(url)
+        base = '{0}/repos/{1}/{2}'.format(self.api_url, user_str, repo_str)
+        (repo, _), (contributors, _), branches, (activity, _) = \
+            await asyncio.gather(
+                self.get_json(session, base),
+                self.get_json(session, base + '/stats/contributors'),
+                self.get_all(session, base + '/branches'),
+                self.get_json(session, base + '/stats/commit_activity'))
+        if not isinstance(repo, dict):
+            # 204, or still 202 after every retry: there are no repo details
+            raise aiohttp.ClientError('No details of repo {0}'.format(url))
+        contribs = [(str(c['author']['login'] if c['author'] else None),
+                     c['total']) for c in contributors]
+        total = sum([user_num[1] for user_num in contribs])
+        return {
+            'stargazers': repo['stargazers_count'],
+            'fork_count': repo['forks_count'],
+            'commits_by_author': contribs,
+            'num_contributors': len(contribs),
+            'total_commits': total,
+            'repo_owner': repo['owner']['login'],
+            'repo_name': repo['name'],
+            'branches': len(branches),
+            'language': repo['language'],
+            "weekly_commits": [week['total'] for week in activity],
+            'weekly_commits_start': activity[0]['week'] if activity else None,
+            'harvested_at': time.time(),
+            }
+
+    async def try_repo_stats(self, session, url):
+        """repo_stats(), or None (noted in self.failed) if a request fails"""
+        try:
+            return await self.repo_stats(session, url)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+            self.failed[url] = repr(err)
+            return None
+
+    async def harvest(self):
+        """Get the stats of every url in self.urls at once
+
+        :returns: list of stats dictionaries, in the order of self.urls, with
+                  None for repos that couldn't be harvested
+        """
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        async with self.session() as session:
+            return await asyncio.gather(*[self.try_repo_stats(session, url)
+                                          for url in self.urls])
+
+    def work(self, status=False, debug=False, verbose=False, add_to_db=True):
+        """Harvest all of self.urls, then add the results to the DB
+
+        :Example:
+
+        See DashPykpi.asyncstats.AsyncKpiStats()
+        """
+        loop = asyncio.new_event_loop()
+        try:
+            results = loop.run_until_complete(self.harvest())
+        finally:
+            loop.close()
+        for i, stats in enumerate(results):
+            self._store(i, stats, status=status, debug=debug,
+                        verbose=verbose, add_to_db=add_to_db)
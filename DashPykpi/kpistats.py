@@ -1,5 +1,16 @@
 from __future__ import print_function
 import os
+import copy
+import hashlib
+import heapq
+import itertools
+import multiprocessing
+import operator
+import subprocess
+import time
+from collections import Counter
+from functools import reduce
+from multiprocessing.pool import ThreadPool
 from github3 import login
 import pandas as pd
 import numpy as np
@@ -7,12 +18,203 @@ import codecs
 import getpass
 import json
 import requests
-from tinydb import TinyDB, Query
+from requests.adapters import HTTPAdapter
+from tinydb import TinyDB, Query, where
 from bokeh.charts import Area, defaults
 from bokeh.models import HoverTool, ColumnDataSource
 from bokeh.charts import Area, defaults
 from bokeh.plotting import figure
 from bokeh.embed import components
+from bokeh.resources import CDN, INLINE
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """A requests HTTPAdapter that gives every request a default timeout
+
+    :param timeout: (connect, read) timeout in seconds, used when a request
+                    doesn't set its own
+    """
+    def __init__(self, timeout=None, **kwargs):
+        self.timeout = timeout
+        super(TimeoutHTTPAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super(TimeoutHTTPAdapter, self).send(request, **kwargs)
+
+
+class GitHubClient(object):
+    """**An authenticated github3.py session to share between harvesters**
+
+    Logs in to Github once, and tunes the underlying requests session: a
+    connection pool of pool_size kept-alive connections (match this to the
+    number of threads making requests at once; AsyncKpiStats() also opens
+    this many connections), retries of failed connections and a default
+    (connect, read) timeout on every request. Credentials are found the same way as always:
+
+    #. A github-token in a local file in the cwd called 'secret_key'.
+    #. A github-token in the environment variable 'GHUB_API_TOKEN'.
+    #. Otherwise the user is prompted for a username and password.
+
+    One client can be handed to several thread workers. Pickling a client
+    (e.g. to send it to a multiprocessing worker) keeps the credentials and
+    settings only, and the session is rebuilt in the new process.
+
+    :param token: github-token (by default found as above)
+    :param username: Github username, if logging in with a password
+    :param password: Github password, if logging in with a password
+    :param pool_size: max number of pooled connections to Github
+    :param timeout: default (connect, read) timeout in seconds
+    :param max_retries: number of retries of failed connections
+
+    :Example:
+
+    >>> from DashPykpi.kpistats import GitHubClient, GitURLs, KpiStats
+    >>> client = GitHubClient(pool_size=8)
+    >>> urls = GitURLs(client=client).urls
+    >>> test = KpiStats(urls=urls, client=client)
+    """
+    def __init__(self, token=None, username=None, password=None,
+                 pool_size=10, timeout=(5, 30), max_retries=3):
+        if token is None and username is None:
+            token, username, password = self.find_credentials()
+        self.token = token
+        self.username = username
+        self.password = password
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.gh = self.connect()
+
+    def __str__(self):
+        return "A shared, pooled and authenticated Github session."
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['gh']  # sessions can't be pickled, rebuilt on unpickling
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.gh = self.connect()
+
+    def find_credentials(self):
+        """Look for a github-token, or prompt for a username and password
+
+        :returns: (token, username, password) tuple, unused items are None
+        """
+        if os.path.isfile('secret_key'):
+            # Locally, with a secret_key file
+            with open("secret_key") as fn:
+                return fn.read().split()[0], None, None
+        elif os.environ.get('GHUB_API_TOKEN'):
+            # On Travis? (GHUB_API_TOKEN could be set...)
+            return os.environ['GHUB_API_TOKEN'], None, None
+        else:
+            # Or just use username/password method
+            gh_name = input("Username to access github with:")
+            pss = getpass.getpass(prompt='Ghub pswd {0}:'.format(gh_name))
+            return None, gh_name, pss
+
+    def connect(self):
+        """Log in to Github and set up the session's connection pool
+
+        :returns: github3.py.GitHub() object
+        """
+        if self.token:
+            gh = login(token=self.token)
+        else:
+            gh = login(self.username, self.password)
+        session = gh._session
+        adapter = TimeoutHTTPAdapter(timeout=self.timeout,
+                                     pool_connections=self.pool_size,
+                                     pool_maxsize=self.pool_size,
+                                     max_retries=self.max_retries)
+        session.mount('https://', adapter)
+        return gh
+
+
+def split_github_url(url):
+    """Check a github repo url and split it into its user and repo strings
+
+    :param url: a string of format 'https://github.com/<user>/<repo>'
+    :returns: (user, repo) tuple of strings
+    """
+    demo = 'https://github.com/<user>/<repo>'
+    er1 = "Error: url should be a string in format of "
+    er2 = "Error: {0} isn't valid ".format(url)
+    assert type(url) == str, er1 + demo
+    assert url.split('/')[-3] == 'github.com', er2
+    user_str, repo_str = url.split('/')[-2:]
+    return user_str, repo_str
+
+
+def url_shard(url, shard_count):
+    """Shard (from 0) a repo url belongs to, out of shard_count shards
+
+    Uses a hash of the url that is the same on every host and Python
+    version, so each shard can be worked out independently.
+    """
+    key = url.rstrip('/').lower().encode('utf-8')
+    return int(hashlib.md5(key).hexdigest(), 16) % shard_count
+
+
+def shard_file(db_file, shard_index, shard_count):
+    """Name of the per-shard DB file, e.g. 'tinydb_for_KPI.shard-0-of-4.json'"""
+    root, ext = os.path.splitext(db_file)
+    return '{0}.shard-{1}-of-{2}{3}'.format(root, shard_index, shard_count,
+                                            ext)
+
+
+def merge_shards(shard_files, db_file='tinydb_for_KPI.json'):
+    """Combine per-shard DB files from sharded KpiStats() runs into one DB
+
+    Rows are matched by repo_name (as in KpiStats.add_db_row()), and the
+    aggregate tables of db_file are kept up to date. Where a
+    repo appears more than once, the row with the latest 'harvested_at'
+    time is kept, and it is only merged into a row already in db_file if it
+    is newer. Then, as in KpiStats.add_db_row(), only the fields that
+    changed_fields() picks out are written, so the empty stats of a cold
+    repo don't wipe stored ones. Merging the same shard files again
+    therefore changes nothing, and the result doesn't depend on the order
+    of shard_files.
+
+    :param shard_files: list of per-shard TinyDB file paths
+    :param db_file: path of the TinyDB file to merge into
+    :returns: dictionary of repo_name: list of the names of the fields
+              written, for the rows added or changed in db_file (as in
+              KpiStats.changed)
+    """
+    def harvested(row):
+        return row.get('harvested_at') or 0
+
+    newest = {}
+    for fname in sorted(shard_files):
+        for row in TinyDB(fname).all():
+            old = newest.get(row['repo_name'])
+            if old is None or harvested(old) < harvested(row):
+                newest[row['repo_name']] = row
+    db = TinyDB(db_file)
+    aggregates = KpiAggregates(db_file, db=db)
+    changed = {}
+    for name in sorted(newest):
+        row = newest[name]
+        results = db.search(where('repo_name') == name)
+        assert len(results) < 2, "Error, repeat entries in DB for same repo."
+        if len(results) == 0:
+            db.insert(dict(row))
+            aggregates.update(None, row)
+            changed[name] = sorted(row)
+        elif harvested(results[0]) < harvested(row):
+            dirty = changed_fields(results[0], row)
+            if dirty:
+                db.update(dirty, eids=[results[0].eid])
+                new = dict(results[0])
+                new.update(dirty)
+                aggregates.update(results[0], new)
+                changed[name] = sorted(dirty)
+    return changed
 
 
 class KpiStats(object):
@@ -29,13 +231,20 @@ class KpiStats(object):
     #. A github-token can be set as an environment variable
        'GHUB_API_TOKEN' (used this on Travis).
 
-    public repo stats can be retrieved). Two methods can be used to log in.
-    Firstly using a github api token: The program will look for this in a file
-    called 'secret_key' in the local folder. If this is not found the software
-    will default to asking for a username and password. The class should be
+    (See GitHubClient(), which can also be created once and passed in to
+    share a session between several objects.) The class should be
     instansiated with a list of github repo url strings.
 
     :param urls: list of url strings ['https://github.com/<user>/<repo>',]
+    :param db_file: path of the TinyDB file to write to
+    :param client: GitHubClient() to use (a new one is made by default)
+    :param shard_index: which shard of the urls to harvest (from 0)
+    :param shard_count: number of shards the urls are split into
+
+    If shard_count is given, only the urls that hash to shard_index are
+    harvested, and the results go to a per-shard DB file (see shard_file()).
+    Each shard can run on a different host or CI job, and the shard files
+    are then combined with merge_shards().
 
     :returns: KpiStats() object
 
@@ -55,24 +264,33 @@ class KpiStats(object):
     >>> test.work(status=True)
     >>> db = TinyDB('tinydb_for_KPI.json')
     >>> df = pd.DataFrame(db.all())
+
+    Or, split over four jobs and merged afterwards
+
+    >>> test = KpiStats(urls=urls, shard_index=0, shard_count=4)
+    >>> test.work()
+    >>> # ... shards 1-3 run elsewhere, then with all the shard files
+    >>> merge_shards([shard_file('tinydb_for_KPI.json', i, 4)
+    ...               for i in range(4)])
     """
-    def __init__(self, urls):
-        if os.path.isfile('secret_key'):
-            fn = open("secret_key")
-            # Locally, with a secret_key file
-            self.gh = login(token=fn.read().split()[0])
-        elif os.environ.get('GHUB_API_TOKEN'):
-            # On Travis? (GHUB_API_TOKEN could be set...)
-            self.gh = login(token=os.environ['GHUB_API_TOKEN'])
-        else:
-            # Or just use username/password method
-            self.gh_name = input("Username to access github with:")
-            pss = getpass.getpass(prompt='Ghub pswd {0}:'.format(self.gh_name))
-            self.gh = login(self.gh_name, pss)
+    def __init__(self, urls, db_file='tinydb_for_KPI.json', client=None,
+                 shard_index=None, shard_count=None):
+        if client is None:
+            client = GitHubClient()
+        self.client = client
+        self.gh = client.gh
+        if shard_count:
+            er1 = "Error, shard_index should be in range(shard_count)"
+            assert shard_index in range(shard_count), er1
+            urls = [url for url in urls
+                    if url_shard(url, shard_count) == shard_index]
+            db_file = shard_file(db_file, shard_index, shard_count)
         self.urls = urls  # A list of URL strings
         self.repo = None
         self.stats = None
-        self.db = TinyDB('tinydb_for_KPI.json')  # create new or open existing
+        self.db = TinyDB(db_file)  # create new or open existing
+        self.aggregates = KpiAggregates(db_file, db=self.db)
+        self.changed = {}  # repo_name: fields changed by add_db_row()
 
     def __str__(self):
         print("A KPI back-end to extract data from Github.")
@@ -87,12 +305,7 @@ class KpiStats(object):
 
         :returns: github3.py.Repository() object as self.repo()
         """
-        demo = 'https://github.com/<user>/<repo>'
-        er1 = "Error: url should be a string in format of "
-        er2 = "Error: {0} isn't valid ".format(url)
-        assert type(url) == str, er1 + demo
-        assert url.split('/')[-3] == 'github.com', er2
-        user_str, repo_str = url.split('/')[-2:]
+        user_str, repo_str = split_github_url(url)
         self.repo = self.gh.repository(user_str, repo_str)
         return
 
@@ -120,6 +333,7 @@ class KpiStats(object):
         branch_count = len([branch for branch in self.repo.iter_branches()])
         commits_over_time = [commit for commit in self.repo.iter_commit_activity()]
         weekly_commits = [week['total'] for week in commits_over_time]
+        weekly_start = commits_over_time[0]['week'] if commits_over_time else None
         self.stats = {
             'stargazers': self.repo.stargazers,
             'fork_count': self.repo.fork_count,
@@ -131,6 +345,8 @@ class KpiStats(object):
             'branches': branch_count,
             'language': self.repo.language,
             "weekly_commits": weekly_commits,
+            'weekly_commits_start': weekly_start,
+            'harvested_at': time.time(),
             }
         return
 
@@ -138,29 +354,48 @@ class KpiStats(object):
         """KpiStats.add_db_row(self)
 
         Checks if there is a database and entry already present, if there isn't
-        it adds a row to a database. If there is one already, it checks to see
-        if the newly retrieved dictionary has updated info. If so, it removes
-        the old row, and adds in the new one. If there is an error, and there
-        is more than one row per repo it throws an assert error.
+        it adds a row to a database. If there is one already, it works out
+        which fields of the newly retrieved dictionary differ from the stored
+        row (see changed_fields()) and writes only those, leaving the row
+        alone if nothing changed. If there is an error, and there is more than
+        one row per repo it throws an assert error. The aggregate tables in
+        self.aggregates are updated to match, and the names of the fields
+        written are kept in self.changed[repo_name] (e.g. to invalidate
+        downstream caches).
 
         :param: self
         :rtype: updates database connected to self.db
+        :returns: list of the names of the fields written
         """
         DBfield = Query()
-        results = self.db.search(DBfield.repo_name == self.repo.name)
+        results = self.db.search(DBfield.repo_name == self.stats['repo_name'])
         assert len(results) < 2, "Error, repeat entries in DB for same repo."
         if len(results) == 0:  # if no record then add the results
             self.db.insert(self.stats)
+            self.aggregates.update(None, self.stats)
+            dirty = self.stats
         if len(results) == 1:  # if record exists, but the user has rerun code
             eid = results[0].eid
-            if results[0]['total_commits'] < self.stats['total_commits']:
-                self.db.remove(eids=[eid])  # remove the old entry
-                self.db.insert(self.stats)  # add the new entry
+            dirty = self.changed_fields(results[0], self.stats)
+            if dirty:
+                self.db.update(dirty, eids=[eid])  # write the changed fields
+                new = dict(results[0])
+                new.update(dirty)
+                self.aggregates.update(results[0], new)
             else:
                 # condition where an entry exists in DB,
                 # and new stats are no diffrent (no repo changes)
                 pass
-        return
+        if dirty:
+            self.changed[self.stats['repo_name']] = sorted(dirty)
+        return sorted(dirty)
+
+    def changed_fields(self, row, stats):
+        """Fields of a freshly retrieved stats dictionary that need writing
+
+        See DashPykpi.kpistats.changed_fields()
+        """
+        return changed_fields(row, stats)
 
     def clean_state(self):
         """Cleans the stats and repo objects from the class between updates
@@ -195,21 +430,253 @@ class KpiStats(object):
         See DashPykpi.kpistats.KpiStats()
         """
         for i, url in enumerate(self.urls):
-            if status:
-                print("\rComplete...{0:2.0f}%".format(((i+1)/len(self.urls)
-                                                       )*100.,), end="")
             self.get_repo_object_from_url(url=url)
             self.get_repo_stats(debug=debug)
             # Deal with html get timeout bug here -> retry if no commits found
             timeout_bug = self.stats['total_commits'] < 1
             if timeout_bug:
                 self.get_repo_stats()
-            if add_to_db:
-                self.add_db_row()
-            if verbose:
-                for k in sorted(self.stats):
-                    print(k, '-->', self.stats[k])
-            self.clean_state()
+            self._store(i, self.stats, status=status, debug=debug,
+                        verbose=verbose, add_to_db=add_to_db)
+
+    def _store(self, i, stats, status=False, debug=False, verbose=False,
+               add_to_db=True):
+        """Report on the stats of self.urls[i] and add them to the DB
+
+        Shared by the work() methods of every harvester. stats is None for a
+        repo that couldn't be harvested, with the error in self.failed.
+        """
+        if status:
+            print("\rComplete...{0:2.0f}%".format(((i+1)/len(self.urls)
+                                                   )*100.,), end="")
+        if debug:
+            print('\nExamined repo {0}'.format(self.urls[i]))
+        if stats is None:
+            if debug or verbose:
+                print('\nSkipped repo {0}: {1}'.format(
+                    self.urls[i], self.failed[self.urls[i]]))
+            return
+        self.stats = stats
+        if add_to_db:
+            self.add_db_row()
+        if verbose:
+            for k in sorted(self.stats):
+                print(k, '-->', self.stats[k])
+        self.clean_state()
+
+
+# Github's commit activity weeks start on Sunday, 1970-01-04 was the first one
+WEEK_SECONDS = 7 * 24 * 60 * 60
+FIRST_SUNDAY = 3 * 24 * 60 * 60
+
+
+def changed_fields(row, stats):
+    """Fields of a freshly retrieved stats dictionary that need writing
+
+    Compares each field of stats to the stored row. Fields with no value
+    (None, e.g. the stargazers of a GitMirrorStats() row, as git doesn't hold
+    them) never overwrite stored ones, and nor do empty contributor or weekly
+    statistics (Github returns nothing while it computes stats for a cold
+    repo). 'harvested_at' alone never makes a row dirty.
+
+    The weekly_commits series is compared as a whole: if it (or its
+    weekly_commits_start) differs from the stored one, the new series
+    replaces it, so every row holds the window of its latest harvest. A
+    longer stored history (e.g. from GitMirrorStats(weeks=None)) is replaced
+    too, so keep harvesting a DB with the same window.
+
+    :param row: row dictionary as stored in the DB
+    :param stats: dictionary of the form made by KpiStats.get_repo_stats()
+    :returns: dictionary of only the changed fields and new values
+    """
+    skip = ['harvested_at']
+    if not stats.get('commits_by_author'):
+        skip += ['commits_by_author', 'num_contributors', 'total_commits']
+    if not stats.get('weekly_commits'):
+        skip += ['weekly_commits', 'weekly_commits_start']
+    dirty = {}
+    for field in stats:
+        if field in skip or stats[field] is None:
+            continue
+        # Compare as stored, where JSON turns tuples into lists
+        value = json.loads(json.dumps(stats[field]))
+        if row.get(field) != value:
+            dirty[field] = value
+    if dirty and 'harvested_at' in stats:
+        dirty['harvested_at'] = stats['harvested_at']
+    return dirty
+
+
+class GitMirrorStats(KpiStats):
+    """**Gathers repo statistics from local bare git mirrors into a TinyDB**
+
+    An alternative to KpiStats() that does not use Github's statistics API
+    (which only covers the past 52 weeks, answers 202 while it computes the
+    stats of cold repos, and uses up the rate limit). Each url is kept as a
+    bare mirror under mirror_dir, cloned on first use and updated with an
+    incremental 'git fetch' afterwards. The statistics are then computed
+    from the full history of the default branch held in the mirror, for
+    several repos at once.
+
+    The stats dictionaries have the same fields as KpiStats.get_repo_stats()
+    but 'stargazers', 'fork_count' and 'language' are None, as git doesn't
+    hold them. A repo that can't be cloned or fetched is skipped, and the
+    error is kept in self.failed[url].
+
+    :param urls: list of git url strings (or local paths) ending in
+                 '<user>/<repo>'
+    :param mirror_dir: directory holding the bare mirrors
+    :param processes: number of repos to fetch and examine at once
+    :param weeks: length of the weekly_commits series (None for the full
+                  history of the repo)
+    :param db_file: path of the TinyDB file to write to
+
+    :Example:
+
+    >>> from DashPykpi.kpistats import GitMirrorStats
+    >>> test = GitMirrorStats(urls=["https://github.com/UCL-RITS/DashPykpi"])
+    >>> test.work(status=True)
+    """
+    def __init__(self, urls, mirror_dir='git_mirrors', processes=4, weeks=52,
+                 db_file='tinydb_for_KPI.json'):
+        self.urls = urls
+        self.mirror_dir = mirror_dir
+        self.processes = processes
+        self.weeks = weeks
+        self.repo = None
+        self.stats = None
+        self.db = TinyDB(db_file)  # create new or open existing
+        self.aggregates = KpiAggregates(db_file, db=self.db)
+        self.changed = {}  # repo_name: fields changed by add_db_row()
+        self.failed = {}  # url: error, for repos that couldn't be harvested
+
+    def __str__(self):
+        return "A KPI back-end to extract data from local git mirrors."
+
+    def owner_and_name(self, url):
+        """Split a git url (or path) into its owner and repo name strings"""
+        owner, name = url.rstrip('/').split('/')[-2:]
+        if name.endswith('.git'):
+            name = name[:-len('.git')]
+        return owner, name
+
+    def mirror_path(self, url):
+        """Path of the bare mirror of a url, under self.mirror_dir"""
+        owner, name = self.owner_and_name(url)
+        return os.path.join(self.mirror_dir, owner, name + '.git')
+
+    def git(self, path, *args):
+        """Run a git command in the mirror at path and return its output"""
+        cmd = ['git', '--git-dir', path] + list(args)
+        return subprocess.check_output(cmd).decode('utf-8')
+
+    def update_mirror(self, url):
+        """Clone a bare mirror of url, or fetch new objects into an old one
+
+        :param url: git url string (or local path)
+        :returns: path of the mirror
+        """
+        path = self.mirror_path(url)
+        if os.path.isdir(path):
+            self.git(path, 'fetch', '--prune', '--quiet', 'origin')
+        else:
+            subprocess.check_call(['git', 'clone', '--mirror', '--quiet',
+                                   url, path])
+        return path
+
+    def weekly_series(self, timestamps, now=None):
+        """Count commit timestamps into Github style weekly bins
+
+        :param timestamps: list of commit unix timestamps
+        :param now: unix time of the last week in the series (default now)
+        :returns: list of weekly commit totals, oldest week first, ending in
+                  the current week
+        """
+        if now is None:
+            now = time.time()
+        last = int(now - FIRST_SUNDAY) // WEEK_SECONDS
+        weeks = [(ts - FIRST_SUNDAY) // WEEK_SECONDS for ts in timestamps]
+        if self.weeks:
+            first = last - self.weeks + 1
+        else:
+            first = min(weeks + [last])
+        counts = [0] * (last - first + 1)
+        for week in weeks:
+            if first <= week <= last:
+                counts[week - first] += 1
+        return counts
+
+    def mirror_stats(self, path, url):
+        """Identify the statistics of the repo mirrored at path
+
+        :param path: path of a bare mirror
+        :param url: url the mirror was made from
+        :rtype: A dictionary of the same form as KpiStats.get_repo_stats()
+        """
+        try:
+            log = self.git(path, 'log', '--format=%aN%x09%ct', 'HEAD')
+        except subprocess.CalledProcessError:
+            log = ''  # empty repo, there is no HEAD commit yet
+        authors = Counter()
+        timestamps = []
+        for line in log.splitlines():
+            author, timestamp = line.rsplit('\t', 1)
+            authors[author] += 1
+            timestamps.append(int(timestamp))
+        contribs = sorted(authors.items(), key=lambda a: (a[1], a[0]))
+        branches = self.git(path, 'for-each-ref', '--format=%(refname)',
+                            'refs/heads').split()
+        owner, name = self.owner_and_name(url)
+        now = time.time()
+        weekly = self.weekly_series(timestamps, now=now)
+        last = int(now - FIRST_SUNDAY) // WEEK_SECONDS
+        return {
+            'stargazers': None,
+            'fork_count': None,
+            'commits_by_author': contribs,
+            'num_contributors': len(contribs),
+            'total_commits': len(timestamps),
+            'repo_owner': owner,
+            'repo_name': name,
+            'branches': len(branches),
+            'language': None,
+            "weekly_commits": weekly,
+            'weekly_commits_start': FIRST_SUNDAY + (last - len(weekly) + 1) *
+            WEEK_SECONDS,
+            'harvested_at': now,
+            }
+
+    def harvest(self, url):
+        """Update the mirror of a single url and return its stats dictionary
+
+        :returns: stats dictionary, or None (noted in self.failed) if the
+                  mirror couldn't be cloned or fetched
+        """
+        try:
+            return self.mirror_stats(self.update_mirror(url), url)
+        except subprocess.CalledProcessError as err:
+            self.failed[url] = repr(err)
+            return None
+
+    def work(self, status=False, debug=False, verbose=False, add_to_db=True):
+        """Mirror and examine all of self.urls, adding the results to the DB
+
+        Repos are fetched and examined self.processes at a time, while the
+        rows are written to the TinyDB one by one from the calling thread.
+
+        :Example:
+
+        See DashPykpi.kpistats.GitMirrorStats()
+        """
+        pool = ThreadPool(processes=self.processes)
+        try:
+            results = pool.imap(self.harvest, self.urls)
+            for i, stats in enumerate(results):
+                self._store(i, stats, status=status, debug=debug,
+                            verbose=verbose, add_to_db=add_to_db)
+        finally:
+            pool.close()
+            pool.join()
 
 
 class GitURLs(object):
@@ -226,24 +693,418 @@ class GitURLs(object):
     ['https://github.com/benlaken/Comment_BadruddinAslam2014.git',
     'https://github.com/benlaken/Composite_methods_LC13.git',
     'https://github.com/benlaken/ECCO.git']
+
+    :param client: GitHubClient() to use (a new one is made by default)
     """
-    def __init__(self):
-        if os.path.isfile('secret_key'):
-            fn = open("secret_key")
-            # Locally, with a secret_key file
-            self.gh = login(token=fn.read().split()[0])
-        elif os.environ.get('GHUB_API_TOKEN'):
-            # On Travis? (GHUB_API_TOKEN can be set...)
-            self.gh = login(token=os.environ['GHUB_API_TOKEN'])
-        else:
-            # Or just use username/password method
-            self.gh_name = input("Username to access github with:")
-            pss = getpass.getpass(prompt='Ghub pswd {0}:'.format(self.gh_name))
-            self.gh = login(self.gh_name, pss)
+    def __init__(self, client=None):
+        if client is None:
+            client = GitHubClient()
+        self.client = client
+        self.gh = client.gh
         self.urls = [r.clone_url.split('.git')[0]
                      for r in self.gh.iter_repos()]
 
 
+# Fields of the stats dictionaries, and so the columns of the KPI DB
+KPI_FIELDS = ['stargazers', 'fork_count', 'commits_by_author',
+              'num_contributors', 'total_commits', 'repo_owner', 'repo_name',
+              'branches', 'language', 'weekly_commits', 'weekly_commits_start',
+              'harvested_at']
+
+
+def is_active(weekly):
+    """True if a repo's weekly_commits show any real activity"""
+    return sum(weekly) > 1
+
+
+class KpiQuery(object):
+    """**Filter, sort, top-N and projection of the rows in a KPI TinyDB**
+
+    Queries are built up by chaining calls, each of which returns a new
+    KpiQuery, and run against a TinyDB with run(). The filters run inside
+    TinyDB's own search (repeated '==' and '!=' filters hit TinyDB's query
+    cache) before rows are sorted, cut to the top N and reduced to the
+    requested fields. TinyDB has no indexes: a search still reads the whole
+    JSON file and tests every row, but only the matching rows are kept, so
+    GraphKPIs plot methods accept a query in place of building a DataFrame
+    of the whole DB.
+
+    :Example:
+
+    The top 20 repos by stars for one owner
+
+    >>> from DashPykpi.kpistats import KpiQuery, GraphKPIs
+    >>> query = (KpiQuery().where('repo_owner', '==', 'UCL-RITS')
+    ...          .order_by('stargazers', descending=True).limit(20))
+    >>> rows = query.run(TinyDB('tinydb_for_KPI.json'))
+    >>> p = GraphKPIs().xy_scatter(x='stargazers', y='fork_count',
+    ...                            query=query)
+    """
+    operators = {
+        '==': operator.eq,
+        '!=': operator.ne,
+        '<': operator.lt,
+        '<=': operator.le,
+        '>': operator.gt,
+        '>=': operator.ge,
+        }
+
+    def __init__(self):
+        self.conditions = []
+        self.sort_field = None
+        self.descending = False
+        self.max_rows = None
+        self.projection = None
+
+    def __str__(self):
+        return "A query over the rows of a KPI TinyDB."
+
+    def _copy(self, **changes):
+        new = copy.copy(self)
+        new.__dict__.update(changes)
+        return new
+
+    def where(self, field, op, value):
+        """Keep only rows where field op value is true
+
+        :param field: DB column name string, e.g. 'stargazers'
+        :param op: one of '==', '!=', '<', '<=', '>', '>=' or 'in' (rows
+                   where field is None never pass '<', '<=', '>' or '>=')
+        :param value: value to compare to (a list of values for 'in')
+        :return: new KpiQuery
+        """
+        if op == 'in':
+            values = list(value)
+            condition = where(field).test(lambda v: v in values)
+        elif op in ('==', '!='):
+            condition = self.operators[op](where(field), value)
+        else:
+            assert op in self.operators, "Error, unknown operator {0}".format(op)
+            compare = self.operators[op]
+            # Rows where field is None (e.g. from GitMirrorStats) never match
+            condition = where(field).test(
+                lambda v: v is not None and compare(v, value))
+        return self._copy(conditions=self.conditions + [condition])
+
+    def test(self, field, func):
+        """Keep only rows where func(row[field]) is true, e.g. is_active()
+
+        :return: new KpiQuery
+        """
+        condition = where(field).test(func)
+        return self._copy(conditions=self.conditions + [condition])
+
+    def order_by(self, field, descending=False):
+        """Sort the rows by field (rows where it is None come last)
+
+        :return: new KpiQuery
+        """
+        return self._copy(sort_field=field, descending=descending)
+
+    def limit(self, n):
+        """Keep only the first n rows (after sorting)
+
+        :return: new KpiQuery
+        """
+        return self._copy(max_rows=n)
+
+    def fields(self, *names):
+        """Only return the named fields of each row
+
+        :return: new KpiQuery
+        """
+        return self._copy(projection=list(names))
+
+    def search(self, db):
+        """Rows of db passing every filter of the query, in DB order"""
+        if not self.conditions:
+            return db.all()
+        return db.search(reduce(operator.and_, self.conditions))
+
+    def count(self, db):
+        """Number of rows of db passing every filter of the query"""
+        if not self.conditions:
+            return len(db)
+        return db.count(reduce(operator.and_, self.conditions))
+
+    def run(self, db):
+        """Run the query against a TinyDB
+
+        :param db: TinyDB (or TinyDB table) object
+        :return: list of row dictionaries (copies, so changing a row's fields
+                 doesn't change TinyDB's cached results)
+        """
+        rows = self.search(db)
+        if self.sort_field:
+            field = self.sort_field
+            if self.descending:
+                key = lambda row: (row.get(field) is not None, row.get(field))
+                if self.max_rows is not None:
+                    rows = heapq.nlargest(self.max_rows, rows, key=key)
+                else:
+                    rows = sorted(rows, key=key, reverse=True)
+            else:
+                key = lambda row: (row.get(field) is None, row.get(field))
+                if self.max_rows is not None:
+                    rows = heapq.nsmallest(self.max_rows, rows, key=key)
+                else:
+                    rows = sorted(rows, key=key)
+        elif self.max_rows is not None:
+            rows = rows[:self.max_rows]
+        if self.projection:
+            rows = [dict((f, row.get(f)) for f in self.projection)
+                    for row in rows]
+        else:
+            rows = [dict(row) for row in rows]
+        return rows
+
+
+def aggregates_file(db_file):
+    """Name of the aggregates file of a DB, e.g. 'tinydb_for_KPI.aggregates.json'"""
+    root, ext = os.path.splitext(db_file)
+    return '{0}.aggregates{1}'.format(root, ext)
+
+
+class KpiAggregates(object):
+    """**Portfolio totals kept in a small file alongside a KPI TinyDB**
+
+    Holds materialised totals in three tables, one entry per group:
+
+    * 'agg_by_language' and 'agg_by_owner': the number of repos, and their
+      total_commits, stargazers, fork_count and commits in the past 52
+      weeks ('recent_commits'), per language and per repo_owner.
+    * 'agg_by_activity': the number of repos with commits in the last N weeks
+      and their commits in those weeks, for each N in activity_weeks (groups
+      'last_<N>_weeks'), plus the 'active' repos (see is_active()) and 'all'
+      repos (the totals GraphKPIs.weekly_activity(verbose=True) reports).
+
+    The tables are kept in their own JSON file (see aggregates_file()) rather
+    than in the TinyDB file, which TinyDB reads in full on every access, so
+    reading a total costs O(groups) rather than O(repos). update() is called
+    by KpiStats.add_db_row() and merge_shards() every time a row is inserted
+    or replaced, and changes only the groups of that row with a single read
+    and write of the aggregates file. If the file doesn't exist yet it is
+    built from every row of the DB in one pass on first use.
+
+    The file also holds a fingerprint of the DB it was built from (its
+    number of rows and a hash of their repo_names, see fingerprint()), and
+    is rebuilt whenever that no longer matches the DB, e.g. after the DB
+    file is deleted and harvested again. Reads only check it when the DB
+    file's size or modification time changed since the aggregates were
+    saved. Other changes to rows made other than through add_db_row() or
+    merge_shards() don't reach the aggregates: call rebuild() afterwards.
+
+    :param db_file: path of the KPI TinyDB file
+    :param db: TinyDB object already open on db_file (opened if needed)
+
+    :Example:
+
+    >>> from DashPykpi.kpistats import KpiAggregates
+    >>> agg = KpiAggregates('tinydb_for_KPI.json')
+    >>> agg.by_language()['Python']['total_commits']
+    >>> agg.activity()['last_4_weeks']['repos']
+    """
+    activity_weeks = [4, 13, 26, 52]
+    group_tables = {
+        'language': 'agg_by_language',
+        'repo_owner': 'agg_by_owner',
+        }
+    activity_table = 'agg_by_activity'
+
+    def __init__(self, db_file, db=None):
+        self.db_file = db_file
+        self.fname = aggregates_file(db_file)
+        self.db = db
+
+    def __str__(self):
+        return "Materialised portfolio totals of a KPI TinyDB."
+
+    def row_groups(self, row):
+        """Contributions of a single repo row to the aggregate tables
+
+        :param row: KPI row dictionary
+        :returns: list of (table name, group, dictionary of totals) tuples
+        """
+        weekly = row.get('weekly_commits') or []
+        totals = {
+            'repos': 1,
+            'total_commits': row.get('total_commits') or 0,
+            'stargazers': row.get('stargazers') or 0,
+            'fork_count': row.get('fork_count') or 0,
+            'recent_commits': sum(weekly[-52:]),
+            }
+        groups = [(table, row.get(field), totals)
+                  for field, table in sorted(self.group_tables.items())]
+        groups.append((self.activity_table, 'all',
+                       {'repos': 1, 'commits': sum(weekly)}))
+        if is_active(weekly):
+            groups.append((self.activity_table, 'active',
+                           {'repos': 1, 'commits': sum(weekly)}))
+        for weeks in self.activity_weeks:
+            commits = sum(weekly[-weeks:])
+            if commits > 0:
+                groups.append((self.activity_table,
+                               'last_{0}_weeks'.format(weeks),
+                               {'repos': 1, 'commits': commits}))
+        return groups
+
+    def apply(self, tables, row, sign=1):
+        """Add (sign=1) or take away (sign=-1) a row's totals, in memory
+
+        :param tables: {table name: {group: totals}} dictionary to change
+        """
+        for table_name, group, totals in self.row_groups(row):
+            groups = tables.setdefault(table_name, {})
+            found = groups.get(group)
+            if found is None:
+                if sign > 0:
+                    groups[group] = dict(totals)
+                continue
+            new = dict((k, found.get(k, 0) + sign * v)
+                       for k, v in totals.items())
+            if new['repos'] > 0:
+                groups[group] = new
+            else:
+                del groups[group]
+
+    def db_rows(self):
+        """Every row of the DB the aggregates are kept for"""
+        db = self.db if self.db is not None else TinyDB(self.db_file)
+        return db.all()
+
+    def db_stat(self):
+        """(size, modification time, inode) of the DB file, None if missing"""
+        if not os.path.isfile(self.db_file):
+            return None
+        stat = os.stat(self.db_file)
+        return [stat.st_size, stat.st_mtime, stat.st_ino]
+
+    def fingerprint(self, names):
+        """Number of rows and a hash of the repo_names of a DB's rows
+
+        :param names: list of the repo_name of every row
+        """
+        names = sorted(str(name) for name in names)
+        digest = hashlib.md5('\n'.join(names).encode('utf-8')).hexdigest()
+        return [len(names), digest]
+
+    def read_file(self):
+        """Read the aggregates file
+
+        :returns: ({table name: {group: totals}}, stored fingerprint(), stored
+                  db_stat()), or (None, None, None) if the file isn't built
+        """
+        if not os.path.isfile(self.fname):
+            return None, None, None
+        with open(self.fname) as f:
+            stored = json.load(f)
+        if 'tables' not in stored:
+            return None, None, None  # An older format, to be rebuilt
+        # Stored as lists, since groups (e.g. a None language) needn't be str
+        tables = dict((table_name, dict((row['group'], row['totals'])
+                                        for row in rows))
+                      for table_name, rows in stored['tables'].items())
+        return tables, stored.get('fingerprint'), stored.get('db_stat')
+
+    def load(self):
+        """Read the aggregates file, as {table name: {group: totals}}
+
+        The DB is only read if its file has changed since the aggregates were
+        saved, to check that the aggregates still match its rows.
+
+        :returns: the tables, or None if the file hasn't been built or was
+                  built from a DB that has since been replaced
+        """
+        tables, fingerprint, db_stat = self.read_file()
+        if tables is None or db_stat == self.db_stat():
+            return tables
+        current = self.fingerprint([row.get('repo_name')
+                                    for row in self.db_rows()])
+        if fingerprint != current:
+            return None
+        self.save(tables, current)  # Still matches, so note the new db_stat
+        return tables
+
+    def save(self, tables, fingerprint):
+        """Write {table name: {group: totals}} to the aggregates file
+
+        :param fingerprint: fingerprint() of the DB the tables describe
+        """
+        stored = dict((table_name, [{'group': group, 'totals': totals}
+                                    for group, totals in groups.items()])
+                      for table_name, groups in tables.items())
+        with open(self.fname, 'w') as f:
+            json.dump({'tables': stored, 'fingerprint': fingerprint,
+                       'db_stat': self.db_stat()}, f)
+
+    def built(self):
+        """True if the aggregates file has been built for this DB"""
+        return os.path.isfile(self.fname)
+
+    def rebuild(self, rows=None):
+        """Recompute every aggregate table from all the rows of the DB
+
+        The DB is read once and the aggregates file written once.
+
+        :param rows: every row of the DB, if already read
+        :returns: the tables, as {table name: {group: totals}}
+        """
+        if rows is None:
+            rows = self.db_rows()
+        tables = dict((table_name, {}) for table_name in
+                      [self.activity_table] + list(self.group_tables.values()))
+        for row in rows:
+            self.apply(tables, row)
+        self.save(tables, self.fingerprint([row.get('repo_name')
+                                            for row in rows]))
+        return tables
+
+    def update(self, old_row, new_row):
+        """Move the totals from old_row to new_row after a DB write
+
+        Call after new_row has been written to the DB in place of old_row.
+        Either may be None, for an insert or a removal. If the aggregates
+        weren't built from the DB as it was before the write (e.g. the DB
+        file was deleted and started again) they are rebuilt instead.
+        """
+        tables, fingerprint, _ = self.read_file()
+        rows = self.db_rows()
+        names = [row.get('repo_name') for row in rows]
+        # The repo_names of the DB before new_row replaced old_row
+        before = list(names)
+        if new_row and new_row.get('repo_name') in before:
+            before.remove(new_row.get('repo_name'))
+        if old_row:
+            before.append(old_row.get('repo_name'))
+        if tables is None or fingerprint != self.fingerprint(before):
+            self.rebuild(rows)  # new_row is already in the DB, so is counted
+            return
+        if old_row:
+            self.apply(tables, old_row, sign=-1)
+        if new_row:
+            self.apply(tables, new_row, sign=1)
+        self.save(tables, self.fingerprint(names))
+
+    def read(self, table_name):
+        """Groups of an aggregate table, as {group: {total name: value}}"""
+        tables = self.load()
+        if tables is None:
+            tables = self.rebuild()
+        return tables.get(table_name, {})
+
+    def by_language(self):
+        """Totals per language, as {language: {'repos': ..., ...}}"""
+        return self.read(self.group_tables['language'])
+
+    def by_owner(self):
+        """Totals per repo_owner, as {owner: {'repos': ..., ...}}"""
+        return self.read(self.group_tables['repo_owner'])
+
+    def activity(self):
+        """Active repos and their commits, as {bucket: {'repos', 'commits'}}"""
+        return self.read(self.activity_table)
+
+
 class GraphKPIs(object):
     """Graph key statistics from specified repos.
 
@@ -252,18 +1113,70 @@ class GraphKPIs(object):
     Essentially, insert the script and div returned into an html template and
     the div will be replaced by the plot objet. This assumes BokehJS has been
     loaded, either inline or via CDN. (See the link above to copy CDN lines.)
+    To pre-render a whole set of plots see export_dashboard().
+
+    The plot methods take a KpiQuery() to select the repos plotted. The
+    whole DB is only loaded (as self.df) if it is used.
+
+    :param db_file: path of the TinyDB file written by KpiStats()
     """
-    def __init__(self):
+    def __init__(self, db_file='tinydb_for_KPI.json'):
 
-        if os.path.exists('tinydb_for_KPI.json'):
-            self.db = TinyDB('tinydb_for_KPI.json')
-            self.df = pd.DataFrame(self.db.all())
+        if os.path.exists(db_file):
+            self.db_file = db_file
+            self.db = TinyDB(db_file)
+            self._df = None
         else:
             raise IOError('DB file not present')
 
     def __str__(self):
         print("Class for graphing the output of KPIStats held in a DB.")
 
+    @property
+    def df(self):
+        """The whole DB as a pandas DataFrame, loaded on first use"""
+        if self._df is None:
+            self._df = pd.DataFrame(self.db.all())
+        return self._df
+
+    def query_df(self, query):
+        """Run a KpiQuery() against the DB and return a pandas DataFrame
+
+        The DataFrame has the KPI_FIELDS columns (or the query's fields)
+        even if no rows match.
+        """
+        rows = query.run(self.db)
+        if rows:
+            return pd.DataFrame(rows)
+        return pd.DataFrame(columns=query.projection or KPI_FIELDS)
+
+    def scatter_query(self, x, y, query=None, x_range=None, y_range=None):
+        """The KpiQuery() xy_scatter() runs to select the repos it plots
+
+        See xy_scatter() for the parameters.
+        """
+        if query is None:
+            query = (KpiQuery().where('total_commits', '>', 0)
+                     .where('num_contributors', '<', 80))
+        if x_range:
+            query = query.where(x, '>=', x_range[0]).where(x, '<=', x_range[1])
+        if y_range:
+            query = query.where(y, '>=', y_range[0]).where(y, '<=', y_range[1])
+        # Repos without a value (None) for x or y can't be placed
+        return query.where(x, '!=', None).where(y, '!=', None)
+
+    def activity_query(self, query=None, owner=None):
+        """The KpiQuery() weekly_activity() counts all its repos with
+
+        weekly_activity() plots the rows of this query that are active (see
+        is_active()). See weekly_activity() for the parameters.
+        """
+        if query is None:
+            query = KpiQuery()
+        if owner:
+            query = query.where('repo_owner', '==', owner)
+        return query
+
     def auto_title(self, x, y):
         """Plot title creator
 
@@ -280,7 +1193,9 @@ class GraphKPIs(object):
         y = y.split('_')
         return ' '.join(x + ['vs.'] + y).title()
 
-    def xy_scatter(self, x, y, ptitle=None, give_script_div=False):
+    def xy_scatter(self, x, y, ptitle=None, give_script_div=False,
+                   aggregate_above=5000, gridsize=50, x_range=None,
+                   y_range=None, query=None):
         """ Create an x y scatterplot coloured by total_commits
 
         Using Bokeh to insert into a webpage or a Jupyter notebook an x y
@@ -288,8 +1203,21 @@ class GraphKPIs(object):
         the numeric data in the DB, including: 'fork_count', 'stargazers',
         'num_contributors' or 'total_commits'.
 
+        If more than aggregate_above repos are to be plotted, the points are
+        binned into a gridsize x gridsize grid (see binned_scatter()) so the
+        size of the plot stays bounded however many repos are in the DB.
+        Passing x_range and/or y_range restricts the plot to that window
+        before counting, so zooming in on a region falls back to raw points
+        once few enough repos are left.
+
         :param x: e.g. 'fork_count', 'stargazers', 'num_contributors' or 'total_commits'
         :param y: e.g. 'fork_count', 'stargazers', 'num_contributors' or 'total_commits'
+        :param aggregate_above: max number of raw points (None to never bin)
+        :param gridsize: number of bins along each axis when aggregating
+        :param x_range: optional (min, max) tuple to zoom the x axis to
+        :param y_range: optional (min, max) tuple to zoom the y axis to
+        :param query: KpiQuery() selecting the repos to plot (by default
+                      those with commits and fewer than 80 contributors)
         :type x: string
         :type y: string
         :return: Bokeh object or script and div string items
@@ -316,26 +1244,16 @@ class GraphKPIs(object):
         if not ptitle:
             ptitle = self.auto_title(x=x, y=y)
 
-        tmpdf = self.df[self.df['total_commits'] > 0]
-        tmpdf = tmpdf[tmpdf['num_contributors'] < 80]
-        df = tmpdf
-        colormap = {
-            "low": "#8400FF",
-            "mid": "#FF00FF",
-            "high": "#FF0088",
-            "highest": "#FF0000",
-                    }
+        df = self.query_df(self.scatter_query(x, y, query=query,
+                                              x_range=x_range,
+                                              y_range=y_range))
+        if aggregate_above is not None and len(df) > aggregate_above:
+            return self.binned_scatter(df, x=x, y=y, ptitle=ptitle,
+                                       gridsize=gridsize,
+                                       give_script_div=give_script_div)
         # colour points by commit numbers
-        colour_list = []
-        for comitnum in df.total_commits:
-            if comitnum < 10:
-                colour_list.append(colormap['low'])
-            elif comitnum >= 10 and comitnum < 100:
-                colour_list.append(colormap['mid'])
-            elif comitnum >= 100 and comitnum < 1000:
-                colour_list.append(colormap['high'])
-            else:
-                colour_list.append(colormap['highest'])
+        colour_list = [self.commit_colour(comitnum)
+                       for comitnum in df.total_commits]
         source = ColumnDataSource(
             data=dict(
                 fork_count=df.fork_count,
@@ -368,11 +1286,115 @@ class GraphKPIs(object):
         else:
             return(p)
 
+    def commit_colour(self, comitnum):
+        """Colour used for a point (or bin) with comitnum total commits
+
+        :param comitnum: number of commits
+        :return: hex colour string
+        """
+        colormap = {
+            "low": "#8400FF",
+            "mid": "#FF00FF",
+            "high": "#FF0088",
+            "highest": "#FF0000",
+                    }
+        if comitnum < 10:
+            return colormap['low']
+        elif comitnum >= 10 and comitnum < 100:
+            return colormap['mid']
+        elif comitnum >= 100 and comitnum < 1000:
+            return colormap['high']
+        else:
+            return colormap['highest']
+
+    def binned_scatter(self, df, x, y, ptitle, gridsize=50,
+                       give_script_div=False):
+        """Aggregated version of xy_scatter for large numbers of repos
+
+        Bins the repos in df into a rectangular gridsize x gridsize grid with
+        numpy, and draws one rectangle per non-empty bin, coloured by the mean
+        total_commits of the bin and shaded by the number of repos in it. The
+        hover tool gives the repo count and summary stats of each bin. Only
+        the non-empty bins are sent to the browser, so at most gridsize**2
+        glyphs are embedded whatever the size of df. Missing (None) values,
+        such as the stargazers of GitMirrorStats() rows, are left out of the
+        bin totals and means.
+
+        :param df: pandas DataFrame of repos (already filtered)
+        :param x: column name for the x axis
+        :param y: column name for the y axis
+        :param gridsize: number of bins along each axis
+        :return: Bokeh object or script and div string items
+        """
+        xs = df[x].values.astype(float)
+        ys = df[y].values.astype(float)
+        xmin, xmax = xs.min(), xs.max()
+        ymin, ymax = ys.min(), ys.max()
+        # Avoid zero width bins if every repo has the same value
+        xwidth = (xmax - xmin) / gridsize or 1.
+        ywidth = (ymax - ymin) / gridsize or 1.
+        ix = np.clip(((xs - xmin) / xwidth).astype(int), 0, gridsize - 1)
+        iy = np.clip(((ys - ymin) / ywidth).astype(int), 0, gridsize - 1)
+        flat = ix * gridsize + iy
+        nbins = gridsize * gridsize
+        counts = np.bincount(flat, minlength=nbins)
+
+        def bin_totals(field):
+            # Sum and count of the known (not None) values of field per bin
+            known = df[field].notnull().values.astype(float)
+            values = df[field].fillna(0).values.astype(float)
+            return (np.bincount(flat, weights=values, minlength=nbins),
+                    np.bincount(flat, weights=known, minlength=nbins))
+
+        commits, known_commits = bin_totals('total_commits')
+        stars, _ = bin_totals('stargazers')
+        contribs, known_contribs = bin_totals('num_contributors')
+        full = counts.nonzero()[0]
+        counts = counts[full]
+        mean_commits = commits[full] / np.maximum(known_commits[full], 1)
+        source = ColumnDataSource(
+            data=dict(
+                x=xmin + (full // gridsize + 0.5) * xwidth,
+                y=ymin + (full % gridsize + 0.5) * ywidth,
+                num_repos=counts,
+                mean_commits=mean_commits.round(1),
+                total_stargazers=stars[full].astype(int),
+                mean_contributors=(contribs[full] / np.maximum(
+                    known_contribs[full], 1)).round(1),
+                color_by_commits=[self.commit_colour(n) for n in mean_commits],
+                alpha=0.3 + 0.7 * np.log1p(counts) / np.log1p(counts.max()),
+            )
+        )
+        hover = HoverTool(
+                tooltips=[
+                    ("Repos in bin", "@num_repos"),
+                    (x, "@x"),
+                    (y, "@y"),
+                    ("Mean total commits", "@mean_commits"),
+                    ("Total stargazers", "@total_stargazers"),
+                    ("Mean num. contributors", "@mean_contributors"),
+                ]
+            )
+        tools = "pan, resize, wheel_zoom, reset, box_select, save"
+        p = figure(title=ptitle, tools=[tools, hover])
+        p.xaxis.axis_label = x
+        p.yaxis.axis_label = y
+        p.rect('x', 'y', width=xwidth, height=ywidth, source=source,
+               color="color_by_commits", fill_alpha="alpha", line_alpha=0)
+        if give_script_div:
+            script, div = components(p)
+            return script, div
+        else:
+            return(p)
+
     def weekly_activity(self, bin=None, per_repo=False, width=800, height=400,
-                        give_script_div=False, verbose=False):
+                        give_script_div=False, verbose=False, owner=None,
+                        query=None):
         """Create a stacked area plot covering the past 52 weeks of acvitity.
         Plot in the notebook (assuming a TinyDB file exists).
         bin = Number of weekly bins (if none then the resolution is weekly)
+        owner = Only plot repos belonging to this Github user/organisation
+        query = KpiQuery() selecting the repos to plot (by default all)
 
         :Example:
 
@@ -384,31 +1406,47 @@ class GraphKPIs(object):
         >>> #Or, a version with all repos individually and feedback
         >>> show(bk.weekly_activity(per_repo=True, verbose=True))
         """
-        df = self.df
+        plot_all = query is None and not owner
+        query = self.activity_query(query=query, owner=owner)
+        df = self.query_df(query.test('weekly_commits', is_active))
         defaults.width = width
         defaults.height = height
         if per_repo:
             running = 0
             num_repos = 0
             tmp_hold = {}
+            xlab = "months since now" if bin else 'weeks since now'
             for n, weekly in enumerate(df['weekly_commits']):
-                if sum(weekly) > 1:
-                    tmp = weekly
-                    # If binning is required...
-                    if bin:
-                        width = bin
-                        tmp = np.array(tmp)
-                        tmp = tmp[:(tmp.size // width) * width].reshape(-1, width).mean(axis=1)
-                        xlab = "months since now"
-                    else:
-                        xlab = 'weeks since now'
-                    tmp_hold[df['repo_name'][n]] = tmp
-                    running += sum(weekly)
-                    num_repos += 1
+                tmp = weekly
+                # If binning is required...
+                if bin:
+                    width = bin
+                    tmp = np.array(tmp)
+                    tmp = tmp[:(tmp.size // width) * width].reshape(-1, width).mean(axis=1)
+                tmp_hold[df['repo_name'][n]] = tmp
+                running += sum(weekly)
+                num_repos += 1
+            if not tmp_hold:
+                # An empty plot if no repos were active
+                tmp_hold = {'No active repos': np.zeros(52 // bin if bin else 52)}
             if verbose:
+                if plot_all:
+                    # Portfolio totals, read from the aggregates file
+                    aggregates = KpiAggregates(self.db_file, db=self.db)
+                    activity = aggregates.activity()
+                    active = activity.get('active', {})
+                    running = active.get('commits', 0)
+                    num_repos = active.get('repos', 0)
+                    total_repos = activity.get('all', {}).get('repos', 0)
+                else:
+                    total_repos = query.count(self.db)
                 print("{0:3,} commits, in {1} active repos (out of {2} total repos), during past 52 weeks".format(
-                        running, num_repos, len(df)))
-            area = Area(tmp_hold, title="Commits to all repos", legend=None,
+                        running, num_repos, total_repos))
+            if owner:
+                ptitle = "Commits to {0} repos".format(owner)
+            else:
+                ptitle = "Commits to all repos"
+            area = Area(tmp_hold, title=ptitle, legend=None,
                         stack=True, xlabel=xlab,
                         ylabel='Master repo commits/week')
 
@@ -419,12 +1457,11 @@ class GraphKPIs(object):
             else:
                 return(area)
         if not per_repo:
-            tmp = []
-            for n, weekly in enumerate(df['weekly_commits']):
-                if sum(weekly) > 1:
-                    tmp.append(weekly)
-            tmp = np.array(tmp)
-            tmp = tmp.sum(axis=0)
+            if len(df):
+                tmp = np.array(list(df['weekly_commits']))
+                tmp = tmp.sum(axis=0)
+            else:
+                tmp = np.zeros(52)  # An empty plot if no repos were active
             # If binning is required
             if bin:
                 width = bin
@@ -432,8 +1469,13 @@ class GraphKPIs(object):
                 xlab = "months since now"
             else:
                 xlab = "weeks since now"
-            all_weekly_commits = {"All repos": tmp}
-            area = Area(all_weekly_commits, title="Commits to repos",
+            if owner:
+                all_weekly_commits = {owner: tmp}
+                ptitle = "Commits to {0} repos".format(owner)
+            else:
+                all_weekly_commits = {"All repos": tmp}
+                ptitle = "Commits to repos"
+            area = Area(all_weekly_commits, title=ptitle,
                         legend=None, stack=True, xlabel=xlab,
                         ylabel='Master repo commits/week')
             if give_script_div:
@@ -442,3 +1484,133 @@ class GraphKPIs(object):
                 return script, div
             else:
                 return(area)
+
+
+# GraphKPIs object held by each export_dashboard() worker process
+_export_graph = None
+
+
+def _init_export_worker(db_file):
+    """Load the KPI database once per export worker process."""
+    global _export_graph
+    _export_graph = GraphKPIs(db_file=db_file)
+
+
+def _render_plot_spec(spec):
+    """Render a single (name, method, kwargs) plot spec to a script and div."""
+    name, method, kwargs = spec
+    kwargs = dict(kwargs, give_script_div=True)
+    script, div = getattr(_export_graph, method)(**kwargs)
+    return name, script, div
+
+
+def dashboard_plot_specs(db_file='tinydb_for_KPI.json'):
+    """Default set of plots rendered by export_dashboard()
+
+    Every pairing of the numeric KPI columns as an xy_scatter, the combined
+    weekly_activity plot, and one weekly_activity plot per repo owner with
+    any recent activity.
+
+    :param db_file: path of the TinyDB file written by KpiStats()
+    :return: list of (name, GraphKPIs method name, kwargs dict) tuples
+    """
+    fields = ['fork_count', 'stargazers', 'num_contributors', 'total_commits']
+    specs = []
+    for x, y in itertools.combinations(fields, 2):
+        specs.append(('{0}_vs_{1}'.format(x, y), 'xy_scatter',
+                      {'x': x, 'y': y}))
+    specs.append(('weekly_activity', 'weekly_activity', {}))
+    query = KpiQuery().test('weekly_commits', is_active).fields('repo_owner')
+    owners = set(row['repo_owner'] for row in query.run(TinyDB(db_file)))
+    for owner in sorted(owners):
+        specs.append(('weekly_activity_{0}'.format(owner), 'weekly_activity',
+                      {'owner': owner}))
+    return specs
+
+
+# Each exported plot is wrapped in one of these, named after its spec
+EXPORT_PLOT = u"""<div class="kpi-plot" id="{name}">
+{div}
+{script}
+</div>"""
+
+EXPORT_PAGE = u"""<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+{resources}
+</head>
+<body>
+{plots}
+</body>
+</html>
+"""
+
+
+def export_dashboard(out='dashboard.html', specs=None, fragments=False,
+                     db_file='tinydb_for_KPI.json', processes=None,
+                     resources='cdn', title='RSD Dashboard KPIs'):
+    """Pre-render a set of GraphKPIs plots to static HTML
+
+    The plots are rendered in parallel worker processes (each loads the
+    TinyDB file once) and the BokehJS resources are written only once, so
+    the output can be served as static files without running Python on
+    each page view.
+
+    :param out: HTML file to write, or a directory if fragments=True
+    :param specs: list of (name, method, kwargs) tuples, where method is
+                  'xy_scatter' or 'weekly_activity'. Defaults to
+                  dashboard_plot_specs().
+    :param fragments: if True write one '<name>.html' div and script fragment
+                      per plot (each plot is wrapped in a
+                      <div class="kpi-plot" id="<name>">), plus a single 'bokeh_resources.html' holding
+                      the BokehJS tags, into the directory out
+    :param db_file: path of the TinyDB file written by KpiStats()
+    :param processes: number of worker processes (defaults to the CPU count)
+    :param resources: 'cdn' to link BokehJS, or 'inline' to embed it
+    :return: list of the file paths written
+
+    :Example:
+
+    >>> from DashPykpi.kpistats import export_dashboard
+    >>> export_dashboard(out='dashboard.html')
+    >>> # Or, a directory of fragments to include in Django templates
+    >>> export_dashboard(out='kpi_fragments', fragments=True)
+    """
+    assert resources in ('cdn', 'inline'), "Error, resources must be 'cdn' or 'inline'"
+    if not os.path.exists(db_file):
+        raise IOError('DB file not present')
+    if specs is None:
+        specs = dashboard_plot_specs(db_file=db_file)
+    pool = multiprocessing.Pool(processes=processes,
+                                initializer=_init_export_worker,
+                                initargs=(db_file,))
+    try:
+        rendered = pool.map(_render_plot_spec, specs)
+    finally:
+        pool.close()
+        pool.join()
+    res = CDN if resources == 'cdn' else INLINE
+    resource_tags = res.render_css() + res.render_js()
+    written = []
+    if fragments:
+        if not os.path.isdir(out):
+            os.makedirs(out)
+        fname = os.path.join(out, 'bokeh_resources.html')
+        with codecs.open(fname, 'w', 'utf-8') as f:
+            f.write(resource_tags)
+        written.append(fname)
+        for name, script, div in rendered:
+            fname = os.path.join(out, '{0}.html'.format(name))
+            with codecs.open(fname, 'w', 'utf-8') as f:
+                f.write(EXPORT_PLOT.format(name=name, div=div, script=script))
+            written.append(fname)
+    else:
+        plots = '\n'.join(EXPORT_PLOT.format(name=name, div=div, script=script)
+                          for name, script, div in rendered)
+        with codecs.open(out, 'w', 'utf-8') as f:
+            f.write(EXPORT_PAGE.format(title=title, resources=resource_tags,
+                                       plots=plots))
+        written.append(out)
+    return written
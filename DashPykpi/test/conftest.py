@@ -0,0 +1,6 @@
+import sys
+
+collect_ignore = []
+if sys.version_info < (3, 5):
+    # async/await syntax can't be imported on older Pythons
+    collect_ignore.append('test_asyncstats.py')
@@ -0,0 +1,150 @@
+import asyncio
+import threading
+import pytest
+
+aiohttp = pytest.importorskip('aiohttp')
+
+from aiohttp import web
+from DashPykpi.asyncstats import AsyncKpiStats
+from DashPykpi.kpistats import GitHubClient
+
+TOKEN = 'not-a-real-token'
+
+
+class FakeGithub(object):
+    """A local aiohttp server answering like the parts of the Github API used
+
+    'someone/project' has a paginated branch list and contributor stats that
+    are only ready on the second request (202 first), 'someone/empty' has no
+    commits (204 stats), 'someone/gone' doesn't exist (404), and Github is
+    still working on every request for 'someone/cold' (202).
+    """
+    def __init__(self):
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.contributor_requests = 0
+        self.url = None
+        app = web.Application(middlewares=[self.check_request])
+        app.router.add_get('/repos/someone/{repo}', self.repo)
+        app.router.add_get('/repos/someone/{repo}/stats/contributors',
+                           self.contributors)
+        app.router.add_get('/repos/someone/{repo}/branches', self.branches)
+        app.router.add_get('/repos/someone/{repo}/stats/commit_activity',
+                           self.activity)
+        self.app = app
+
+    @web.middleware
+    async def check_request(self, request, handler):
+        if request.headers.get('Authorization') != 'token ' + TOKEN:
+            return web.json_response({'message': 'Bad credentials'}, status=401)
+        if request.match_info['repo'] == 'gone':
+            return web.json_response({'message': 'Not Found'}, status=404)
+        if request.match_info['repo'] == 'cold':
+            return web.json_response({}, status=202)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(0.05)
+            return await handler(request)
+        finally:
+            self.in_flight -= 1
+
+    async def repo(self, request):
+        return web.json_response({
+            'stargazers_count': 5, 'forks_count': 2,
+            'name': request.match_info['repo'],
+            'owner': {'login': 'someone'}, 'language': 'Python'})
+
+    async def contributors(self, request):
+        if request.match_info['repo'] == 'empty':
+            return web.Response(status=204)
+        self.contributor_requests += 1
+        if self.contributor_requests == 1:
+            return web.json_response({}, status=202)  # still computing
+        return web.json_response([{'author': {'login': 'alice'}, 'total': 7},
+                                  {'author': None, 'total': 1}])
+
+    async def branches(self, request):
+        if request.match_info['repo'] == 'empty':
+            return web.json_response([])
+        if request.query.get('page') == '2':
+            return web.json_response([{'name': 'dev'}, {'name': 'fix'}])
+        link = '<{0}/repos/someone/project/branches?page=2>; rel="next"'
+        return web.json_response([{'name': 'master'}],
+                                 headers={'Link': link.format(self.url)})
+
+    async def activity(self, request):
+        if request.match_info['repo'] == 'empty':
+            return web.Response(status=204)
+        return web.json_response([{'total': n, 'week': 604800 * n}
+                                  for n in range(52)])
+
+
+@pytest.fixture
+def fake_github():
+    """Run a FakeGithub on its own event loop in a background thread"""
+    fake = FakeGithub()
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(fake.app)
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    loop.run_until_complete(site.start())
+    port = site._server.sockets[0].getsockname()[1]
+    fake.url = 'http://127.0.0.1:{0}'.format(port)
+    thread = threading.Thread(target=loop.run_forever)
+    thread.start()
+    yield fake
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.run_until_complete(runner.cleanup())
+    loop.close()
+
+
+def make_harvester(tmpdir, fake_github, urls, pool_size=10):
+    client = GitHubClient(token=TOKEN, pool_size=pool_size)
+    test = AsyncKpiStats(urls=urls, db_file=str(tmpdir.join('kpi.json')),
+                         client=client, retry_wait=0.01)
+    test.api_url = fake_github.url
+    return test
+
+
+def test_async_harvester_stats(tmpdir, fake_github):
+    """Check the async harvester fills the KpiStats schema over HTTP"""
+    test = make_harvester(tmpdir, fake_github,
+                          ['https://github.com/someone/project'])
+    test.work()
+    row = test.db.all()[0]
+    assert fake_github.contributor_requests == 2, "Error, 202 not retried"
+    assert row['commits_by_author'] == [['alice', 7], ['None', 1]]
+    assert row['total_commits'] == 8
+    assert row['num_contributors'] == 2
+    assert row['branches'] == 3, "Error, branch pages not followed"
+    assert row['stargazers'] == 5
+    assert row['repo_owner'] == 'someone'
+    assert row['weekly_commits'] == list(range(52))
+    assert row['weekly_commits_start'] == 0
+    assert fake_github.max_in_flight == 4, "Error, requests not made at once"
+
+
+def test_async_harvester_skips_failed_repos(tmpdir, fake_github):
+    """Check a missing repo is skipped without losing the other repos"""
+    test = make_harvester(tmpdir, fake_github,
+                          ['https://github.com/someone/gone',
+                           'https://github.com/someone/empty',
+                           'https://github.com/someone/cold'])
+    test.work()
+    assert sorted(test.failed) == ['https://github.com/someone/cold',
+                                   'https://github.com/someone/gone']
+    row = test.db.all()[0]
+    assert row['repo_name'] == 'empty'
+    assert row['commits_by_author'] == []
+    assert row['weekly_commits'] == []
+    assert len(test.db) == 1
+
+
+def test_async_harvester_pool_size(tmpdir, fake_github):
+    """Check requests share the client's pool_size connections"""
+    test = make_harvester(tmpdir, fake_github,
+                          ['https://github.com/someone/project'], pool_size=2)
+    test.work()
+    assert fake_github.max_in_flight == 2
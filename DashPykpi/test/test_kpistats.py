@@ -1,10 +1,49 @@
 from __future__ import print_function
 from DashPykpi.kpistats import KpiStats, GitURLs, GraphKPIs
+from DashPykpi.kpistats import export_dashboard, GitMirrorStats
+from DashPykpi.kpistats import dashboard_plot_specs
+from DashPykpi.kpistats import GitHubClient, KpiQuery
+from DashPykpi.kpistats import merge_shards, shard_file, KpiAggregates
+from DashPykpi.kpistats import WEEK_SECONDS, aggregates_file
+from tinydb import TinyDB, where
+from bokeh.resources import CDN
+from bokeh.models import GlyphRenderer
 import os
 import sys
+import pickle
+import subprocess
 from pytest import raises
 
 
+def make_test_db(fname, num_repos=6):
+    """Write a small TinyDB of made-up KPI rows, so no Github access needed."""
+    db = TinyDB(fname)
+    for n in range(num_repos):
+        db.insert({
+            'stargazers': n * 3,
+            'fork_count': n,
+            'commits_by_author': [('user{0}'.format(n), 10 * (n + 1))],
+            'num_contributors': 1 + n % 3,
+            'total_commits': 10 * (n + 1),
+            'repo_owner': ['ownerA', 'ownerB'][n % 2],
+            'repo_name': 'repo{0}'.format(n),
+            'branches': 1 + n % 2,
+            'language': ['Python', 'C++', None][n % 3],
+            'weekly_commits': [(n + week) % 4 for week in range(52)],
+            })
+    return db
+
+
+def git_commit(repo, author, message):
+    """Make a commit as author in the local git repo at path repo"""
+    with open(os.path.join(repo, 'log.txt'), 'a') as f:
+        f.write(message + '\n')
+    subprocess.check_call(['git', '-C', repo, 'add', 'log.txt'])
+    subprocess.check_call(['git', '-C', repo, '-c', 'user.name=' + author,
+                           '-c', 'user.email=test@example.com', 'commit',
+                           '-q', '-m', message])
+
+
 def test_public_repo_access():
     if os.path.isfile('tinydb_for_KPI.json'):
         os.remove('tinydb_for_KPI.json')
@@ -82,3 +121,341 @@ def test_error_if_no_db():
         os.rename(tmp_fname, db_fname)
     else:
         print("No tinydb file present: unable to test GraphKPIs error raising")
+
+
+def test_export_dashboard_single_page(tmpdir):
+    """Check a static page is written with every plot and BokehJS only once"""
+    db_fname = str(tmpdir.join('kpi.json'))
+    make_test_db(db_fname)
+    out = str(tmpdir.join('dashboard.html'))
+    written = export_dashboard(out=out, db_file=db_fname, processes=2)
+    assert written == [out]
+    html = open(out).read()
+    assert html.count(CDN.js_files[0]) == 1, "BokehJS not included once"
+    # 6 scatter pairings, the combined activity plot and one per owner
+    names = [name for name, method, kwargs in dashboard_plot_specs(db_fname)]
+    assert len(names) == 9
+    assert html.count('class="kpi-plot"') == 9, "Error, wrong number of plots"
+    for name in names:
+        assert html.count('id="{0}"'.format(name)) == 1
+
+
+def test_export_dashboard_fragments(tmpdir):
+    """Check a directory of per-plot fragments and one resources file"""
+    db_fname = str(tmpdir.join('kpi.json'))
+    make_test_db(db_fname)
+    out = str(tmpdir.join('fragments'))
+    specs = [('stars', 'xy_scatter', {'x': 'stargazers', 'y': 'fork_count'}),
+             ('ownerA', 'weekly_activity', {'owner': 'ownerA'})]
+    written = export_dashboard(out=out, specs=specs, fragments=True,
+                               db_file=db_fname, processes=2)
+    names = sorted(os.path.basename(fname) for fname in written)
+    assert names == ['bokeh_resources.html', 'ownerA.html', 'stars.html']
+    assert CDN.js_files[0] not in open(os.path.join(out, 'stars.html')).read()
+    assert 'id="ownerA"' in open(os.path.join(out, 'ownerA.html')).read()
+
+
+def test_xyplot_aggregates_large_portfolios(tmpdir):
+    """Check xy_scatter bins points above aggregate_above, raw ones below"""
+    db_fname = str(tmpdir.join('kpi.json'))
+    make_test_db(db_fname, num_repos=200)
+    grobj = GraphKPIs(db_file=db_fname)
+    p = grobj.xy_scatter(x='stargazers', y='fork_count', aggregate_above=50,
+                         gridsize=5)
+    glyphs = [r for r in p.renderers if isinstance(r, GlyphRenderer)]
+    data = glyphs[0].data_source.data
+    assert 0 < len(data['num_repos']) <= 25, "Error, too many bins"
+    assert sum(data['num_repos']) == 200, "Error, repos lost when binning"
+    # zooming in to a small window falls back to raw points
+    p = grobj.xy_scatter(x='stargazers', y='fork_count', aggregate_above=50,
+                         x_range=(0, 30))
+    glyphs = [r for r in p.renderers if isinstance(r, GlyphRenderer)]
+    assert len(glyphs[0].data_source.data['repo_name']) == 11
+
+
+def test_binned_scatter_skips_missing_values(tmpdir):
+    """Check binning works when stats are missing, as from GitMirrorStats"""
+    db_fname = str(tmpdir.join('kpi.json'))
+    db = make_test_db(db_fname, num_repos=200)
+    for row in db.all():
+        if row['fork_count'] % 2:
+            db.update({'stargazers': None}, eids=[row.eid])
+    grobj = GraphKPIs(db_file=db_fname)
+    p = grobj.xy_scatter(x='num_contributors', y='total_commits',
+                         aggregate_above=50, gridsize=5)
+    glyphs = [r for r in p.renderers if isinstance(r, GlyphRenderer)]
+    data = glyphs[0].data_source.data
+    assert sum(data['num_repos']) == 200
+    # Only the repos with an even fork_count still have their stars
+    assert sum(data['total_stargazers']) == sum(n * 3 for n in range(0, 200, 2))
+
+
+def test_git_mirror_harvester(tmpdir):
+    """Check stats from local git mirrors, and that mirrors update"""
+    repo = str(tmpdir.join('someone', 'project'))
+    subprocess.check_call(['git', 'init', '-q', repo])
+    git_commit(repo, 'alice', 'one')
+    git_commit(repo, 'alice', 'two')
+    git_commit(repo, 'bob', 'three')
+    subprocess.check_call(['git', '-C', repo, 'branch', 'feature'])
+    db_fname = str(tmpdir.join('kpi.json'))
+    test = GitMirrorStats(urls=[repo], mirror_dir=str(tmpdir.join('mirrors')),
+                          db_file=db_fname)
+    test.work()
+    row = test.db.all()[0]
+    assert row['repo_owner'] == 'someone'
+    assert row['repo_name'] == 'project'
+    assert row['total_commits'] == 3
+    assert row['num_contributors'] == 2
+    assert row['branches'] == 2
+    assert len(row['weekly_commits']) == 52
+    assert row['weekly_commits'][-1] == 3
+    # New commits arrive with an incremental fetch into the existing mirror
+    git_commit(repo, 'carol', 'four')
+    test.work()
+    rows = test.db.all()
+    assert len(rows) == 1, "Error, repeat entries in DB for same repo"
+    assert rows[0]['total_commits'] == 4
+    assert rows[0]['num_contributors'] == 3
+
+
+def test_git_mirror_harvester_skips_failed_repos(tmpdir):
+    """Check a repo that can't be cloned doesn't stop the others"""
+    repo = str(tmpdir.join('someone', 'project'))
+    subprocess.check_call(['git', 'init', '-q', repo])
+    git_commit(repo, 'alice', 'one')
+    missing = [str(tmpdir.join('someone', name)) for name in ('gone', 'lost')]
+    test = GitMirrorStats(urls=[missing[0], repo, missing[1]],
+                          mirror_dir=str(tmpdir.join('mirrors')),
+                          db_file=str(tmpdir.join('kpi.json')))
+    test.work()
+    assert sorted(test.failed) == missing
+    assert [row['repo_name'] for row in test.db.all()] == ['project']
+
+
+def test_github_client_pool_and_pickle():
+    """Check the shared client's session is pooled, and rebuilt on unpickle"""
+    client = GitHubClient(token='not-a-real-token', pool_size=4)
+    adapter = client.gh._session.get_adapter('https://api.github.com')
+    assert adapter._pool_maxsize == 4, "Error, pool not sized for workers"
+    assert adapter.timeout == (5, 30), "Error, no default timeout"
+    assert str(client) == "A shared, pooled and authenticated Github session."
+    copy = pickle.loads(pickle.dumps(client))
+    assert copy.token == client.token
+    assert copy.gh is not client.gh, "Error, session not rebuilt"
+    adapter = copy.gh._session.get_adapter('https://api.github.com')
+    assert adapter._pool_maxsize == 4
+
+
+def test_kpi_query(tmpdir):
+    """Check filtering, top-N sorting and projection of DB rows"""
+    db = make_test_db(str(tmpdir.join('kpi.json')), num_repos=10)
+    query = (KpiQuery().where('repo_owner', '==', 'ownerA')
+             .order_by('stargazers', descending=True).limit(3)
+             .fields('repo_name', 'stargazers'))
+    assert str(query) == "A query over the rows of a KPI TinyDB."
+    assert query.run(db) == [{'repo_name': 'repo8', 'stargazers': 24},
+                             {'repo_name': 'repo6', 'stargazers': 18},
+                             {'repo_name': 'repo4', 'stargazers': 12}]
+    query = KpiQuery().where('language', 'in', ['C++', None])
+    assert query.count(db) == 6
+    rows = query.order_by('language').run(db)
+    assert [row['language'] for row in rows] == ['C++'] * 3 + [None] * 3
+    # Changing the rows returned doesn't change TinyDB's cached results
+    query = KpiQuery().where('repo_owner', '==', 'ownerA')
+    query.run(db)[0]['language'] = 'Fortran'
+    assert query.run(db)[0]['language'] == 'Python'
+
+
+def test_plots_accept_queries(tmpdir):
+    """Check plots are made from only the repos selected by a query"""
+    db_fname = str(tmpdir.join('kpi.json'))
+    make_test_db(db_fname, num_repos=10)
+    grobj = GraphKPIs(db_file=db_fname)
+    query = KpiQuery().where('repo_owner', '==', 'ownerB').limit(2)
+    p = grobj.xy_scatter(x='stargazers', y='fork_count', query=query)
+    glyphs = [r for r in p.renderers if isinstance(r, GlyphRenderer)]
+    assert list(glyphs[0].data_source.data['repo_name']) == ['repo1', 'repo3']
+    grobj.weekly_activity(per_repo=True, query=query)
+    assert grobj._df is None, "Error, whole DB loaded for a query"
+
+
+def test_sharded_kpistats_partition(tmpdir):
+    """Check shards split the urls between them, with one DB file each"""
+    urls = ['https://github.com/someone/repo{0}'.format(n) for n in range(20)]
+    client = GitHubClient(token='not-a-real-token')
+    db_fname = str(tmpdir.join('kpi.json'))
+    sharded = []
+    for i in range(3):
+        test = KpiStats(urls=urls, db_file=db_fname, client=client,
+                        shard_index=i, shard_count=3)
+        assert os.path.isfile(shard_file(db_fname, i, 3))
+        sharded += test.urls
+    assert sorted(sharded) == sorted(urls), "Error, urls lost or repeated"
+
+
+def test_merge_shards(tmpdir):
+    """Check shard merging keeps the newest row per repo, idempotently"""
+    shards = [str(tmpdir.join('shard{0}.json'.format(i))) for i in range(2)]
+    old, new = make_test_db(shards[0], 4), make_test_db(shards[1], 2)
+    for row in old.all():
+        old.update({'harvested_at': 100}, eids=[row.eid])
+    for row in new.all():
+        new.update({'harvested_at': 200, 'stargazers': 99}, eids=[row.eid])
+    db_fname = str(tmpdir.join('kpi.json'))
+    assert len(merge_shards(shards, db_file=db_fname)) == 4
+    rows = dict((row['repo_name'], row) for row in TinyDB(db_fname).all())
+    assert sorted(rows) == ['repo0', 'repo1', 'repo2', 'repo3']
+    assert rows['repo0']['stargazers'] == 99
+    assert rows['repo2']['stargazers'] == 6
+    assert merge_shards(shards[::-1], db_file=db_fname) == {}
+    assert len(TinyDB(db_fname)) == 4
+    # A newer harvest of a cold repo only writes what it has real values for
+    cold = TinyDB(str(tmpdir.join('shard2.json')))
+    cold.insert(dict(rows['repo1'], commits_by_author=[], num_contributors=0,
+                     total_commits=0, weekly_commits=[], stargazers=100,
+                     weekly_commits_start=None, harvested_at=300))
+    changed = merge_shards(shards + [str(tmpdir.join('shard2.json'))],
+                           db_file=db_fname)
+    assert changed == {'repo1': ['harvested_at', 'stargazers']}
+    row = TinyDB(db_fname).search(where('repo_name') == 'repo1')[0]
+    assert row['stargazers'] == 100
+    assert row['total_commits'] == rows['repo1']['total_commits']
+    assert row['weekly_commits'] == rows['repo1']['weekly_commits']
+
+
+def test_aggregates_maintained_on_insert(tmpdir):
+    """Check aggregate tables follow add_db_row inserts and replacements"""
+    rows = make_test_db(str(tmpdir.join('rows.json')), num_repos=6).all()
+    test = KpiStats(urls=[], db_file=str(tmpdir.join('kpi.json')),
+                    client=GitHubClient(token='not-a-real-token'))
+    for row in rows:
+        test.stats = dict(row)
+        test.add_db_row()
+    by_language = test.aggregates.by_language()
+    assert by_language['Python'] == {'repos': 2, 'total_commits': 50,
+                                     'stargazers': 9, 'fork_count': 3,
+                                     'recent_commits': 156}
+    assert test.aggregates.by_owner()['ownerA']['repos'] == 3
+    assert test.aggregates.activity()['all']['repos'] == 6
+    # A replaced row moves its totals between groups
+    test.stats = dict(rows[0], language='R', total_commits=1000)
+    test.add_db_row()
+    by_language = test.aggregates.by_language()
+    assert by_language['Python']['repos'] == 1
+    assert by_language['R']['total_commits'] == 1000
+    # Totals are kept out of the (large) DB file, in their own small file
+    assert test.db.tables() == set(['_default'])
+    assert os.path.isfile(aggregates_file(str(tmpdir.join('kpi.json'))))
+    incremental = (test.aggregates.by_language(), test.aggregates.by_owner(),
+                   test.aggregates.activity())
+    test.aggregates.rebuild()
+    assert incremental == (test.aggregates.by_language(),
+                           test.aggregates.by_owner(),
+                           test.aggregates.activity())
+
+
+def test_aggregates_rebuilt_for_new_db(tmpdir):
+    """Check deleting the DB and harvesting again doesn't double the totals"""
+    rows = make_test_db(str(tmpdir.join('rows.json')), num_repos=3).all()
+    db_fname = str(tmpdir.join('kpi.json'))
+    for harvest in range(2):
+        if os.path.isfile(db_fname):
+            os.remove(db_fname)
+        test = KpiStats(urls=[], db_file=db_fname,
+                        client=GitHubClient(token='not-a-real-token'))
+        for row in rows:
+            test.stats = dict(row)
+            test.add_db_row()
+        test.db.close()
+    assert os.path.isfile(aggregates_file(db_fname))
+    aggregates = KpiAggregates(db_fname)
+    assert len(TinyDB(db_fname)) == 3
+    assert aggregates.activity()['all']['repos'] == 3
+    assert aggregates.by_owner()['ownerA']['repos'] == 2
+    # Deleting the DB between reads is noticed too
+    os.remove(db_fname)
+    make_test_db(db_fname, num_repos=1).close()
+    assert aggregates.activity()['all']['repos'] == 1
+
+
+def test_add_db_row_writes_changed_fields(tmpdir):
+    """Check only changed fields are written, whatever total_commits does"""
+    row = make_test_db(str(tmpdir.join('rows.json')), num_repos=1).all()[0]
+    start = 1000 * WEEK_SECONDS
+    test = KpiStats(urls=[], db_file=str(tmpdir.join('kpi.json')),
+                    client=GitHubClient(token='not-a-real-token'))
+    test.stats = dict(row, weekly_commits_start=start, harvested_at=1)
+    test.add_db_row()
+    # Unchanged stats, apart from when they were harvested, aren't written
+    test.stats = dict(test.stats, harvested_at=2)
+    assert test.add_db_row() == []
+    # More stars, but no new commits
+    test.stats = dict(test.stats, stargazers=50, harvested_at=3)
+    assert test.add_db_row() == ['harvested_at', 'stargazers']
+    # A week later: the window moves on and one new week has commits
+    weekly = row['weekly_commits'][1:] + [9]
+    test.stats = dict(test.stats, weekly_commits=weekly, harvested_at=4,
+                      weekly_commits_start=start + WEEK_SECONDS)
+    assert test.add_db_row() == ['harvested_at', 'weekly_commits',
+                                 'weekly_commits_start']
+    stored = test.db.all()[0]
+    assert stored['weekly_commits'] == weekly
+    assert stored['stargazers'] == 50
+    # Empty stats from a cold repo don't wipe the stored ones
+    test.stats = dict(test.stats, commits_by_author=[], num_contributors=0,
+                      total_commits=0, weekly_commits=[], harvested_at=5)
+    assert test.add_db_row() == []
+    assert test.db.all()[0]['total_commits'] == row['total_commits']
+    # Nor do the missing values of a GitMirrorStats() harvest
+    test.stats = dict(test.stats, stargazers=None, fork_count=None,
+                      language=None, harvested_at=6)
+    assert test.add_db_row() == []
+    assert test.db.all()[0]['stargazers'] == 50
+
+
+def test_weekly_activity_owner_titles(tmpdir):
+    """Check plots of one owner's repos are titled with the owner"""
+    db_fname = str(tmpdir.join('kpi.json'))
+    make_test_db(db_fname)
+    grobj = GraphKPIs(db_file=db_fname)
+    area = grobj.weekly_activity(per_repo=True, owner='ownerA')
+    assert area.title.text == 'Commits to ownerA repos'
+    area = grobj.weekly_activity(owner='ownerA')
+    assert area.title.text == 'Commits to ownerA repos'
+
+
+def test_queries_skip_missing_values(tmpdir):
+    """Check rows with None values (as from GitMirrorStats) don't break queries"""
+    db_fname = str(tmpdir.join('kpi.json'))
+    db = make_test_db(db_fname, num_repos=4)
+    for row in db.all()[:2]:
+        db.update({'stargazers': None, 'fork_count': None}, eids=[row.eid])
+    assert KpiQuery().where('stargazers', '>', 6).count(db) == 1
+    assert KpiQuery().where('stargazers', '==', None).count(db) == 2
+    grobj = GraphKPIs(db_file=db_fname)
+    p = grobj.xy_scatter(x='stargazers', y='fork_count', x_range=(0, 20))
+    glyphs = [r for r in p.renderers if isinstance(r, GlyphRenderer)]
+    assert list(glyphs[0].data_source.data['repo_name']) == ['repo2', 'repo3']
+
+
+def test_plots_with_no_matching_repos(tmpdir):
+    """Check plots are still made when a query or zoom matches no repos"""
+    db_fname = str(tmpdir.join('kpi.json'))
+    make_test_db(db_fname)
+    grobj = GraphKPIs(db_file=db_fname)
+    p = grobj.xy_scatter(x='stargazers', y='fork_count', x_range=(1000, 2000))
+    glyphs = [r for r in p.renderers if isinstance(r, GlyphRenderer)]
+    assert len(glyphs[0].data_source.data['repo_name']) == 0
+    assert grobj.weekly_activity(owner='nobody') is not None
+    assert grobj.weekly_activity(owner='nobody', per_repo=True, bin=4) is not None
+
+
+def test_weekly_activity_verbose_totals(tmpdir, capsys):
+    """Check verbose totals, read from the aggregates, match the DB"""
+    db_fname = str(tmpdir.join('kpi.json'))
+    make_test_db(db_fname)
+    GraphKPIs(db_file=db_fname).weekly_activity(per_repo=True, verbose=True)
+    out = capsys.readouterr()[0]
+    assert "468 commits, in 6 active repos (out of 6 total repos)" in out
+    assert KpiAggregates(db_fname).activity()['all']['repos'] == 6
@@ -0,0 +1,257 @@
+"""Benchmarks for loading and plotting KPI databases with GraphKPIs
+
+Generates synthetic KPI databases (no Github access needed) of several
+sizes and, for each, times loading the whole DB with GraphKPIs (its df
+DataFrame), running the DB query each plot makes, building each plot
+(query included), and serialising it with components(), along with the
+size of the script and div produced and the peak memory used.
+
+The per_repo weekly_activity plots draw one series per active repo, so
+they are only measured for DBs of up to --per-repo-max repos (10,000 by
+default); above that they take far longer than everything else together.
+
+Results can be saved as a baseline, and later runs compared against it,
+flagging any measurement that got worse by more than a tolerance.
+
+:Example:
+
+Record baselines, then check a later version of the code against them
+(with DashPykpi installed)
+
+$ python benchmarks/bench_graphkpis.py --save
+$ python benchmarks/bench_graphkpis.py --compare --tolerance 0.25
+
+Or, just the smaller sizes
+
+$ python benchmarks/bench_graphkpis.py --sizes 100 10000
+
+Or, the per_repo plots at every size (slow)
+
+$ python benchmarks/bench_graphkpis.py --per-repo-max 100000
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+from timeit import default_timer as timer
+import numpy as np
+from tinydb import TinyDB
+from bokeh.embed import components
+from DashPykpi.kpistats import GraphKPIs, is_active
+
+try:
+    import tracemalloc  # Python 3 only
+except ImportError:
+    tracemalloc = None
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'baselines.json')
+SIZES = [100, 10000, 100000]
+PER_REPO_MAX = 10000
+LANGUAGES = ['Python', 'C++', 'Fortran', 'R', 'Jupyter Notebook', 'C',
+             'JavaScript', None]
+
+# name: (GraphKPIs method, kwargs) of the plots measured
+PLOTS = [
+    ('xy_scatter', ('xy_scatter', {'x': 'stargazers', 'y': 'fork_count'})),
+    ('xy_scatter_raw', ('xy_scatter', {'x': 'stargazers', 'y': 'fork_count',
+                                       'aggregate_above': None})),
+    ('weekly_activity', ('weekly_activity', {})),
+    ('weekly_activity_bin', ('weekly_activity', {'bin': 4})),
+    ('weekly_activity_per_repo', ('weekly_activity', {'per_repo': True})),
+    ('weekly_activity_per_repo_bin', ('weekly_activity',
+                                      {'per_repo': True, 'bin': 4})),
+    ]
+
+
+def make_synthetic_db(fname, num_repos, seed=0):
+    """Write a TinyDB of num_repos made-up rows in the KpiStats schema
+
+    The values are drawn from long-tailed distributions similar to a real
+    portfolio: most repos have few stars and little recent activity, a few
+    have a lot. The same seed always gives the same DB.
+
+    :param fname: path of the TinyDB file to create
+    :param num_repos: number of rows
+    :param seed: random seed
+    """
+    rnd = np.random.RandomState(seed)
+    stars = rnd.zipf(2., num_repos) - 1
+    forks = rnd.binomial(stars, 0.2)
+    contributors = np.minimum(rnd.zipf(2.5, num_repos), 200)
+    commits = rnd.lognormal(3., 1.5, num_repos).astype(int) + contributors
+    activity = rnd.exponential(0.5, num_repos) * (rnd.rand(num_repos) < 0.4)
+    rows = []
+    for n in range(num_repos):
+        weekly = rnd.poisson(activity[n], 52)
+        rows.append({
+            'stargazers': int(stars[n]),
+            'fork_count': int(forks[n]),
+            'commits_by_author': [['user{0}'.format(n), int(commits[n])]],
+            'num_contributors': int(contributors[n]),
+            'total_commits': int(commits[n]),
+            'repo_owner': 'owner{0}'.format(n % 50),
+            'repo_name': 'repo{0}'.format(n),
+            'branches': int(rnd.randint(1, 10)),
+            'language': LANGUAGES[n % len(LANGUAGES)],
+            'weekly_commits': [int(w) for w in weekly],
+            'harvested_at': 1.5e9,
+            })
+    db = TinyDB(fname)
+    db.insert_multiple(rows)
+    db.close()
+
+
+def timed(func):
+    """Call func(), returning its result and the time taken in seconds"""
+    start = timer()
+    result = func()
+    return result, timer() - start
+
+
+def peak_memory(func):
+    """Peak memory in MB allocated while calling func() (None on Python 2)"""
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1] / 1e6
+    finally:
+        tracemalloc.stop()
+
+
+def load_df(db_fname):
+    """Open a DB with GraphKPIs and load all of it, as GraphKPIs.df does"""
+    return GraphKPIs(db_file=db_fname).df
+
+
+def plot_query(grobj, method, kwargs):
+    """The KpiQuery() a GraphKPIs plot method runs for the given kwargs"""
+    if method == 'xy_scatter':
+        return grobj.scatter_query(kwargs['x'], kwargs['y'])
+    query = grobj.activity_query(owner=kwargs.get('owner'))
+    return query.test('weekly_commits', is_active)
+
+
+def bench_size(db_fname, plots=PLOTS, memory=True):
+    """Measure loading and every plot in plots for a single DB file
+
+    :param plots: list of plots to measure, in the form of PLOTS
+    :returns: dictionary of measurement name to value, times in seconds,
+              sizes in bytes and memory in MB
+    """
+    results = {}
+    _, results['load_s'] = timed(lambda: load_df(db_fname))
+    if memory:
+        results['load_peak_mb'] = peak_memory(lambda: load_df(db_fname))
+    grobj = GraphKPIs(db_file=db_fname)
+    for name, (method, kwargs) in plots:
+        # A new GraphKPIs each time, so TinyDB's query cache is empty
+        query = plot_query(grobj, method, kwargs)
+        fresh = GraphKPIs(db_file=db_fname)
+        _, results[name + '_query_s'] = timed(lambda: fresh.query_df(query))
+        if memory:
+            fresh = GraphKPIs(db_file=db_fname)
+            results[name + '_query_peak_mb'] = peak_memory(
+                lambda: fresh.query_df(query))
+        plot = getattr(GraphKPIs(db_file=db_fname), method)
+        p, results[name + '_build_s'] = timed(lambda: plot(**kwargs))
+        (script, div), results[name + '_components_s'] = timed(
+            lambda: components(p))
+        results[name + '_bytes'] = len(script.encode('utf-8')) + \
+            len(div.encode('utf-8'))
+        if memory:
+            plot = getattr(GraphKPIs(db_file=db_fname), method)
+            results[name + '_peak_mb'] = peak_memory(
+                lambda: components(plot(**kwargs)))
+    return results
+
+
+def run(sizes=SIZES, memory=True, verbose=True, per_repo_max=PER_REPO_MAX):
+    """Run the benchmarks for every DB size in sizes
+
+    :param per_repo_max: largest size to measure the per_repo plots at
+    :returns: dictionary of str(size) to bench_size() results
+    """
+    tmpdir = tempfile.mkdtemp()
+    results = {}
+    try:
+        for size in sizes:
+            db_fname = os.path.join(tmpdir, 'kpi_{0}.json'.format(size))
+            make_synthetic_db(db_fname, size)
+            plots = [(name, (method, kwargs))
+                     for name, (method, kwargs) in PLOTS
+                     if size <= per_repo_max or not kwargs.get('per_repo')]
+            results[str(size)] = bench_size(db_fname, plots=plots,
+                                            memory=memory)
+            if verbose:
+                print('\n{0:,} repos'.format(size))
+                for k in sorted(results[str(size)]):
+                    print('  {0:40} {1}'.format(k, results[str(size)][k]))
+    finally:
+        shutil.rmtree(tmpdir)
+    return results
+
+
+def regressions(results, baseline, tolerance=0.25):
+    """Measurements worse than their baseline by more than tolerance
+
+    :param results: output of run()
+    :param baseline: output of an earlier run()
+    :param tolerance: allowed fractional increase (0.25 is 25% worse)
+    :returns: list of (size, measurement, baseline, new value) tuples
+    """
+    worse = []
+    for size in sorted(results, key=int):
+        for k in sorted(results[size]):
+            old = baseline.get(size, {}).get(k)
+            new = results[size][k]
+            if old is not None and new is not None and \
+                    new > old * (1. + tolerance):
+                worse.append((size, k, old, new))
+    return worse
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES,
+                        help='number of repos in each synthetic DB')
+    parser.add_argument('--per-repo-max', type=int, default=PER_REPO_MAX,
+                        help='largest DB size to measure the per_repo plots '
+                        'at (they draw one series per active repo)')
+    parser.add_argument('--no-memory', action='store_true',
+                        help="don't measure peak memory (quicker)")
+    parser.add_argument('--save', action='store_true',
+                        help='save the results as the new baselines')
+    parser.add_argument('--compare', action='store_true',
+                        help='compare the results against the baselines')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='fractional slow down flagged as a regression')
+    parser.add_argument('--baseline-file', default=BASELINE_FILE)
+    args = parser.parse_args(argv)
+
+    results = run(sizes=args.sizes, memory=not args.no_memory,
+                  per_repo_max=args.per_repo_max)
+    if args.save:
+        with open(args.baseline_file, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print('\nBaselines saved to {0}'.format(args.baseline_file))
+    if args.compare:
+        with open(args.baseline_file) as f:
+            baseline = json.load(f)
+        worse = regressions(results, baseline, tolerance=args.tolerance)
+        for size, k, old, new in worse:
+            print('REGRESSION {0} repos {1}: {2:.4g} -> {3:.4g}'.format(
+                size, k, old, new))
+        if worse:
+            return 1
+        print('\nNo regressions against {0}'.format(args.baseline_file))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())